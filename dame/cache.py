@@ -0,0 +1,125 @@
+from collections import OrderedDict
+from threading import Lock
+import sys
+
+import numpy as np
+
+
+def result_nbytes(obj):
+    r"""Approximate size of a result in memory, arrays at any depth included."""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes + sys.getsizeof(obj) if obj.base is None else obj.nbytes
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(
+            result_nbytes(k) + result_nbytes(v) for k, v in obj.items()
+        )
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(result_nbytes(v) for v in obj)
+    return sys.getsizeof(obj)
+
+
+class MemoryCache:
+    r"""A bounded in-memory cache of transform results.
+
+    Workers look results up in the cache before the store and put there the
+    results they load or compute, see :class:`dame.worker.SequentialWorker`.
+    Results are keyed by (transform version, idx) and shared, they must not be
+    modified in place.
+
+    A cache given to a process pool is copied empty to every worker process. The
+    copies' counters are added to the cache's when the pool is closed (see
+    :meth:`dame.worker.WorkManager.close`), until then :meth:`stats` counts only
+    the lookups of the calling process. Thread pools and ``Dataset.__getitem__``
+    share the instance.
+
+    Args:
+        max_entries (int, optional): Bound on the number of results.
+        max_bytes (int, optional): Bound on the size of the results, see
+            :func:`result_nbytes`. A result larger than the bound is not cached.
+        policy (str): "lru" - evicts the least recently used result, "ring" -
+            evicts the oldest one, hits don't reorder the results.
+    """
+
+    policies = ("lru", "ring")
+
+    def __init__(self, max_entries=None, max_bytes=None, policy="lru"):
+        assert policy in self.policies, f"Policy must be one of {self.policies}"
+        self.max_entries, self.max_bytes = max_entries, max_bytes
+        self.policy = policy
+        self.lock = Lock()
+        self.clear()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ("lock", "entries", "sizes"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        self.entries, self.sizes = OrderedDict(), {}
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        r"""The cached result or None, counts a hit or a miss."""
+        with self.lock:
+            value = self.entries.get(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self.policy == "lru":
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = result_nbytes(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.sizes[key]
+                del self.entries[key]
+            self.entries[key], self.sizes[key] = value, size
+            self.nbytes += size
+            while (
+                self.max_entries is not None and len(self.entries) > self.max_entries
+            ) or (self.max_bytes is not None and self.nbytes > self.max_bytes):
+                old, _ = self.entries.popitem(last=False)
+                self.nbytes -= self.sizes.pop(old)
+                self.evictions += 1
+
+    def add_counters(self, counters):
+        r"""Adds the hits, misses and evictions of a copy, see :meth:`stats`."""
+        with self.lock:
+            self.hits += counters["hits"]
+            self.misses += counters["misses"]
+            self.evictions += counters["evictions"]
+
+    def stats(self):
+        r"""Counters for tuning the bounds.
+
+        Returns:
+            dict: hits, misses, evictions, entries, bytes and the hit rate
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
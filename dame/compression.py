@@ -0,0 +1,90 @@
+r"""Compression of stored results.
+
+zlib, lzma and bz2 are always available, lz4 and zstd when the lz4 or zstandard
+packages are installed.
+"""
+import bz2
+import lzma
+import pickle
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+CODECS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+    "bz2": (bz2.compress, bz2.decompress),
+}
+if lz4 is not None:
+    CODECS["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+if zstandard is not None:
+    CODECS["zstd"] = (
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+
+def get_codec(name):
+    assert name in CODECS, f"Codec {name} is not available, one of {list(CODECS)}"
+    return CODECS[name]
+
+
+def compress(name, data):
+    return get_codec(name)[0](data)
+
+
+def decompress(name, data):
+    return get_codec(name)[1](data)
+
+
+class CompressedValue:
+    r"""A value of a result compressed on its own, see :func:`compress_values`."""
+
+    __slots__ = ("codec", "blob")
+
+    def __init__(self, codec, blob):
+        self.codec, self.blob = codec, blob
+
+    def __reduce__(self):
+        return CompressedValue, (self.codec, self.blob)
+
+    def value(self):
+        return pickle.loads(decompress(self.codec, self.blob))
+
+
+def compress_values(data, codecs):
+    r"""Compresses the values of data with the codecs given for their keys.
+
+    Args:
+        data (dict): a result
+        codecs (dict): `{key: codec name}`
+
+    Returns:
+        dict: data with the values replaced by :class:`CompressedValue`
+    """
+    data = dict(data)
+    for key, name in codecs.items():
+        if key in data:
+            blob = pickle.dumps(data[key], protocol=pickle.HIGHEST_PROTOCOL)
+            data[key] = CompressedValue(name, compress(name, blob))
+    return data
+
+
+def decompress_values(data):
+    r"""Reverts :func:`compress_values`, data without compressed values is kept."""
+    if not isinstance(data, dict) or not any(
+        isinstance(value, CompressedValue) for value in data.values()
+    ):
+        return data
+    return {
+        key: value.value() if isinstance(value, CompressedValue) else value
+        for key, value in data.items()
+    }
@@ -12,13 +12,28 @@ class Dataset:
     What you probably want to do is to subclass this class and redefine it's source
     and transforms attributes.
 
+    The workers are started on first use and kept alive between iterations. Call
+    :meth:`close` (or use the dataset as a context manager) to stop them.
+
+    Optional attributes n_processes, store, chunksize, ordering, reorder_buffer,
+    batch_size, executor, single_writer, transport, cache and keep configure the
+    computation, see :class:`dame.worker.WorkManager`.
+
+    Transforms may define ``apply_batch``. It gets a list of values for every
+    argument of ``apply`` and returns a list of per-element results.
+
+    Reducers are computed in the first full iteration, see :meth:`reduce`.
+
     Attributes:
         source (Source_cls): As lightweight as possible data source
         transforms (Iterable[Transform_cls]): Processing of data items at element level
+        reducers (Iterable[Reducer_cls]): Computations on the whole dataset, their
+            results are constants for the transforms, see :class:`dame.reducer.Reducer`
 
     """
     source = None
     transforms = tuple()
+    reducers = tuple()
     context = {}
 
     @property
@@ -32,10 +47,31 @@ class Dataset:
                 self.transforms,
                 self.context,
                 n_processes=getattr(self, "n_processes", None),
-                store=getattr(self, "store", None)
+                store=getattr(self, "store", None),
+                chunksize=getattr(self, "chunksize", 1),
+                ordering=getattr(self, "ordering", "strict"),
+                reorder_buffer=getattr(self, "reorder_buffer", 256),
+                batch_size=getattr(self, "batch_size", 1),
+                executor=getattr(self, "executor", "process"),
+                single_writer=getattr(self, "single_writer", False),
+                transport=getattr(self, "transport", "pickle"),
+                cache=getattr(self, "cache", None),
+                keep=getattr(self, "keep", None),
+                reducers=self.reducers,
             )
         return self._manager
 
+    def close(self):
+        r"""Stops the workers and releases their resources (e.g. the store)."""
+        if getattr(self, "_manager", None) is not None:
+            self._manager.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def __getitem__(self, idx):
         r"""Computes a single dataset element"""
         return self.manager.compute_one(idx)
@@ -50,15 +86,82 @@ class Dataset:
     def assequence(self, of=None):
         r"""Returns a sequence of `{key: computed_value for key in of}`
 
+        Only the transforms needed for the keywords are computed. Keywords the
+        dataset doesn't provide are left out of the elements, as :meth:`select`
+        would raise a KeyError for them.
+
         Args:
-            of (str|set(str), optional): the keywords to keep in each element.
-                Defaults to None.
+            of (str|set(str), optional): the keywords to keep in each element, a
+                str is a single keyword. Defaults to None.
         """
         if of is None:
             return iter(self)
-        return map(
-            lambda data: {key: value for key, value in data.items() if key in of}, self
-        )
+        if isinstance(of, str):
+            of = (of,)
+        stages = self.manager.stages
+        provided = set(stages.provider) | stages.external(stages.source)
+        keys = tuple(key for key in of if key in provided)
+        if not keys:
+            return ({} for _ in self.select("idx"))
+        return self.select(*keys)
+
+    def select(self, *keys):
+        r"""Returns an iterator over `{key: computed_value for key in keys}`
+
+        Workers compute only the transforms needed for the keys and send back
+        only the selected values.
+
+        Args:
+            *keys (str): the keywords to compute
+        """
+        return self.manager.fast_compute(keys=keys)
+
+    def iter_chunks(self, size, *keys):
+        r"""Returns an iterator over chunks of consecutive elements as columns.
+
+        Each transform computes the whole chunk before the next one starts, see
+        :meth:`dame.worker.WorkManager.compute_chunks`.
+
+        Args:
+            size (int): number of elements in a chunk, the last one may be smaller
+            *keys (str): the keywords to compute. Defaults to all.
+
+        Returns:
+            iterator: `{key: [values of the chunk's elements]}`
+        """
+        return self.manager.compute_chunks(size, keys=keys or None)
+
+    def sweep(self, grid, *keys):
+        r"""Computes the dataset in every configuration of a grid of arguments.
+
+        Stages sharing their arguments and inputs across the configurations are
+        computed once, all the configurations are computed in a single pass.
+
+        Args:
+            grid (dict): `{Transform_cls: [{"args": [...], "kwargs": {...}}, ...]}`
+                the arguments to try for every transform, see
+                :meth:`set_arguments_for`
+            *keys (str): the keywords to compute. Defaults to all.
+
+        Returns:
+            tuple(list(dict), iterator): the context of every configuration and
+                an iterator over lists of an element's values in them
+        """
+        manager = self.manager
+        contexts = manager.sweep_contexts(grid)
+        return contexts, manager.sweep(grid, keys=keys or None)
+
+    def reduce(self):
+        r"""Returns the results of the reducers.
+
+        They are loaded from the store or computed in the same pass as the first
+        full iteration. If no iteration has computed them, a pass computing only
+        their inputs is made.
+
+        Returns:
+            dict: `{key: value}` for the keys provided by the reducers
+        """
+        return self.manager.reduce()
 
     def set_arguments_for(self, transform, *args, **kwargs):
         r"""Provide arguments to use when creating transform instances.
@@ -71,6 +174,8 @@ class Dataset:
         """
         ctx = {"args": args, "kwargs": kwargs}
         self.context[transform.__name__] = ctx
+        if getattr(self, "_manager", None) is not None:
+            self._manager.restart()
 
     def validate(self):
         r"""Validates (roughly) the subclass's transforms and source
@@ -105,7 +210,10 @@ class Dataset:
 
         keywords = [
             chain.from_iterable(
-                [t.provides for t in chain(self.transforms, (self.source,))]
+                [
+                    t.provides
+                    for t in chain(self.transforms, self.reducers, (self.source,))
+                ]
             )
         ]
         return keywords
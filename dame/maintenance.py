@@ -0,0 +1,173 @@
+r"""Maintenance of stores: listing, garbage collection, retention and compaction.
+
+Every new version of a transform gets its own results, the results of older
+versions stay in the store until they are deleted here. Also available from the
+command line, see ``dame-store --help``.
+"""
+from argparse import ArgumentParser
+from collections import namedtuple
+from datetime import datetime, timedelta
+from importlib import import_module
+from itertools import chain
+
+from .worker import SequentialWorker
+
+Report = namedtuple("Report", ["versions", "results", "nbytes"])
+Report.__doc__ = """Numbers of deleted versions and results and their size in bytes."""
+
+
+def reachable_versions(datasets):
+    r"""Versions of the transforms and reducers of the datasets.
+
+    The versions depend on the datasets' contexts (see
+    :meth:`dame.Dataset.set_arguments_for`), pass dataset instances configured
+    like the ones in use.
+
+    Args:
+        datasets (iterable(Dataset)): the datasets whose results to keep
+
+    Returns:
+        set(tuple(str, str)): (name, digest) of every version
+    """
+    versions = set()
+    for dataset in datasets:
+        manager = dataset.manager
+        worker = SequentialWorker(manager.stages, manager.context)
+        for transform in chain(manager.stages, manager.reducers):
+            digest = worker.stage_instance(transform).version()
+            versions.add((transform.__name__, digest))
+    return versions
+
+
+def delete(store, versions, dry_run=False):
+    r"""Deletes the versions (see :meth:`PeeWeeStore.versions`) from the store.
+
+    Returns:
+        Report: what was (or, with dry_run, would be) deleted
+    """
+    ids = [version["id"] for version in versions]
+    results = sum(version["results"] for version in versions)
+    nbytes = store.exclusive_nbytes(ids) if ids else 0
+    if not dry_run and ids:
+        store.delete_versions(ids)
+    return Report(len(ids), results, nbytes)
+
+
+def collect_garbage(store, datasets, dry_run=False):
+    r"""Deletes the results no dataset can reach, see :func:`reachable_versions`.
+
+    Returns:
+        Report: what was deleted
+    """
+    reachable = reachable_versions(datasets)
+    return delete(
+        store,
+        [
+            version
+            for version in store.versions()
+            if (version["name"], version["digest"]) not in reachable
+        ],
+        dry_run,
+    )
+
+
+def retain(store, max_age=None, max_bytes=None, datasets=(), dry_run=False):
+    r"""Deletes old versions, those of the datasets are never deleted.
+
+    Args:
+        store (PeeWeeStore): an open store
+        max_age (timedelta, optional): versions created earlier are deleted
+        max_bytes (int, optional): the oldest versions are deleted until the
+            results take at most max_bytes, see :meth:`PeeWeeStore.exclusive_nbytes`
+        datasets (iterable(Dataset)): datasets whose versions to keep
+        dry_run (bool): only report what would be deleted
+
+    Returns:
+        Report: what was deleted
+    """
+    protected = reachable_versions(datasets)
+    versions, doomed = store.versions(), []
+    total = remaining = store.exclusive_nbytes()
+    for version in versions:
+        if (version["name"], version["digest"]) in protected:
+            continue
+        too_old = max_age is not None and version["created"] < datetime.now() - max_age
+        too_big = max_bytes is not None and remaining > max_bytes
+        if too_old or too_big:
+            doomed.append(version)
+            # Blobs shared with versions still kept free nothing
+            remaining = total - store.exclusive_nbytes(v["id"] for v in doomed)
+    return delete(store, doomed, dry_run)
+
+
+def load_object(path):
+    r"""Imports "package.module:name"."""
+    module, _, name = path.partition(":")
+    return getattr(import_module(module), name)
+
+
+def main(argv=None):
+    r"""The ``dame-store`` command."""
+    parser = ArgumentParser(prog="dame-store", description=__doc__.split("\n")[0])
+    parser.add_argument("database", help="path of the SQLite database")
+    parser.add_argument(
+        "--store", default="dame.storage:PeeWeeStore", help="store class, module:name"
+    )
+    parser.add_argument("--array-dir", help="array directory of MmapStore")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="list stored versions")
+    gc = commands.add_parser("gc", help="delete results no dataset can reach")
+    gc.add_argument(
+        "--dataset",
+        action="append",
+        default=[],
+        required=True,
+        help="dataset class in use, module:name (repeatable)",
+    )
+    retention = commands.add_parser("retain", help="delete old versions")
+    retention.add_argument("--max-age", type=float, help="in days")
+    retention.add_argument("--max-bytes", type=int)
+    retention.add_argument(
+        "--dataset", action="append", default=[], help="dataset whose versions to keep"
+    )
+    for command in (gc, retention):
+        command.add_argument("--dry-run", action="store_true")
+        command.add_argument(
+            "--compact", action="store_true", help="compact the database afterwards"
+        )
+    commands.add_parser("compact", help="reclaim the space of deleted results")
+    args = parser.parse_args(argv)
+
+    kwargs = {"array_dir": args.array_dir} if args.array_dir else {}
+    store = load_object(args.store)((), **kwargs)
+    store.open(args.database)
+    try:
+        if args.command == "list":
+            for v in store.versions():
+                print(
+                    f"{v['id']:>6} {v['name']:<32} {v['digest'][:12]} "
+                    f"{v['created']:%Y-%m-%d %H:%M} {v['results']:>8} {v['nbytes']:>12}"
+                )
+            return
+        if args.command in ("gc", "retain"):
+            datasets = [load_object(path)() for path in args.dataset]
+            if args.command == "gc":
+                report = collect_garbage(store, datasets, args.dry_run)
+            else:
+                max_age = timedelta(days=args.max_age) if args.max_age else None
+                report = retain(store, max_age, args.max_bytes, datasets, args.dry_run)
+            verb = "Would delete" if args.dry_run else "Deleted"
+            print(
+                f"{verb} {report.versions} versions, {report.results} results, "
+                f"{report.nbytes} bytes"
+            )
+            if args.dry_run or not args.compact:
+                return
+        print(f"Compacting {args.database}")
+        print(f"Reclaimed {store.compact()} bytes")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+from .versionable import Versionable
+
+
+class Reducer(Versionable):
+    r"""Computes something on the whole dataset, e.g. a mean or a vocabulary.
+
+    A reducer runs in the same pass as the transforms. Every task of the workers
+    folds its elements into a partial accumulator, the accumulators are combined
+    pairwise in a tree as they arrive (see :class:`TreeCombiner`) and finished in
+    the main process. The result is saved to
+    the store (at index -1) under the reducer's version. Transforms declared after
+    it may take its provided keys as arguments, they are constant for all the
+    elements.
+
+    Subclasses define provides and the methods below. update declares the keys it
+    needs as keyword-only arguments, like the transforms' apply.
+
+    Attributes:
+        provides (tuple(str)): keys of the result
+    """
+
+    provides = ()
+
+    def start(self):
+        r"""Returns an empty accumulator."""
+        raise NotImplementedError
+
+    def update(self, accumulator, **data):
+        r"""Returns the accumulator updated with an element."""
+        raise NotImplementedError
+
+    def combine(self, first, second):
+        r"""Returns an accumulator merging two partial ones."""
+        raise NotImplementedError
+
+    def finish(self, accumulator):
+        r"""Returns the result, `{key: value for key in provides}`."""
+        raise NotImplementedError
+
+
+class TreeCombiner:
+    r"""Combines accumulators pairwise in a tree, as they arrive.
+
+    Two accumulators made of the same number of (power of two) arrived ones are
+    combined right away, so at most one accumulator per level of the tree is
+    kept: O(log n) of them for n arrived. The earlier accumulator is always the
+    first argument of combine.
+
+    Args:
+        combine (callable): merges two accumulators, see :meth:`Reducer.combine`
+    """
+
+    def __init__(self, combine):
+        self.combine = combine
+        self.levels = []
+
+    def add(self, accumulator):
+        level = 0
+        while self.levels and self.levels[-1][0] == level:
+            accumulator = self.combine(self.levels.pop()[1], accumulator)
+            level += 1
+        self.levels.append((level, accumulator))
+
+    def __bool__(self):
+        return bool(self.levels)
+
+    def result(self):
+        r"""Combines the accumulators kept into a single one."""
+        assert self.levels, "Nothing to combine"
+        accumulator = self.levels[-1][1]
+        for _, first in reversed(self.levels[:-1]):
+            accumulator = self.combine(first, accumulator)
+        return accumulator
+
+
+def tree_combine(combine, accumulators):
+    r"""Combines accumulators pairwise, in a tree, into a single one."""
+    combiner = TreeCombiner(combine)
+    for accumulator in accumulators:
+        combiner.add(accumulator)
+    return combiner.result()
@@ -0,0 +1,72 @@
+r"""Pickling with protocol 5, keeping numpy arrays (at any depth) out-of-band.
+
+The arrays' memory is not copied into the pickle. It is returned separately (or
+packed into a single aligned frame) and the arrays are rebuilt as views of it.
+"""
+import pickle
+import struct
+
+MAGIC = b"DAMEOOB5"
+
+
+def dumps(obj):
+    r"""Pickles obj, leaving out the buffers of contiguous arrays.
+
+    Returns:
+        tuple(bytes, list(memoryview)): the pickle and the out-of-band buffers
+    """
+    buffers = []
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    return data, [buffer.raw() for buffer in buffers]
+
+
+def loads(data, buffers=()):
+    return pickle.loads(data, buffers=buffers)
+
+
+def pack(buffers, alignment=64):
+    r"""Packs the buffers into a single frame, each one aligned.
+
+    The buffers are copied once, straight into the frame. Being bytes, the frame
+    is pickled (e.g. by multiprocessing) without another copy.
+
+    Returns:
+        bytes: the frame, see :func:`unpack`
+    """
+    header = len(MAGIC) + 8 * (1 + 2 * len(buffers))
+    entries, parts, end = [], [], header
+    for buffer in buffers:
+        padding = -end % alignment
+        parts += [bytes(padding), buffer]
+        entries += [end + padding, buffer.nbytes]
+        end += padding + buffer.nbytes
+    head = MAGIC + struct.pack(f"<{len(entries) + 1}Q", len(buffers), *entries)
+    return b"".join([head] + parts)
+
+
+def is_packed(blob):
+    return blob[: len(MAGIC)] == MAGIC
+
+
+def unpack(frame):
+    r"""Views of the buffers in a frame made by :func:`pack`, nothing is copied.
+
+    The arrays rebuilt from the views are writable only if the frame is (e.g. a
+    bytearray), those of a bytes frame are read-only.
+    """
+    count = struct.unpack_from("<Q", frame, len(MAGIC))[0]
+    entries = struct.unpack_from(f"<{2 * count}Q", frame, len(MAGIC) + 8)
+    view = memoryview(frame)
+    return [view[o : o + n] for o, n in zip(entries[::2], entries[1::2])]
+
+
+def frame(obj):
+    r"""Pickles obj into a (pickle, frame) pair, see :func:`unframe`."""
+    data, buffers = dumps(obj)
+    return data, pack(buffers) if buffers else None
+
+
+def unframe(framed):
+    r"""Rebuilds an object pickled by :func:`frame`, arrays are views of the frame."""
+    data, packed = framed
+    return loads(data, unpack(packed) if packed is not None else ())
@@ -1,15 +1,44 @@
+from collections import OrderedDict
+from tempfile import TemporaryFile
+import mmap
+import pickle
+
+
 class SourceWrap:
     r"""Helper class to relax requirements for a source.
     It solves two problems:
         1) the source doesn't have to supply the index key in data
         2) __getitem__ provided for sources that only contain __iter__.
-            It's fast when accesing elements in increasing order.
+            It's fast when accesing elements in increasing order. The last
+            buffer_size elements are kept for nearly sequential access. Random
+            access is served by an index of elements spilled to a sidecar file.
+
+    Arguments are taken from ``context["SourceWrap"]`` by the work manager.
+
+    Args:
+        source_instance: the source
+        index (str): When to spill elements of an iterator-only source to the
+            index. "never" - an element before the last one read (and not buffered)
+            restarts the iterator, "always" - every element read is spilled, "auto"
+            - the iterator is restarted once (on the first such element) to build
+            the index from then on. Defaults to "auto".
+        buffer_size (int): Number of recently read elements kept in memory.
+        index_dir (str, optional): Directory of the sidecar file, a temporary file
+            is removed once the wrapper is closed or collected.
     """
 
-    def __init__(self, source_instance):
+    indexes = ("never", "always", "auto")
+
+    def __init__(self, source_instance, index="auto", buffer_size=64, index_dir=None):
+        assert index in self.indexes, f"Index must be one of {self.indexes}"
         self.instance = source_instance
+        self.index, self.buffer_size, self.index_dir = index, buffer_size, index_dir
         self._hack_iter = None
         self._hack_next_idx = None
+        self._buffer = OrderedDict()
+        self._spill = None
+        self._offsets = []
+        self._mmap = None
 
     def __getitem__(self, idx):
         if hasattr(self.instance, "__getitem__"):
@@ -21,13 +50,53 @@ class SourceWrap:
             yield {**data, "idx": idx}
 
     def hack_getitem(self, idx):
-
+        if idx in self._buffer:
+            self._buffer.move_to_end(idx)
+            return {**self._buffer[idx], "idx": idx}
+        if idx < len(self._offsets):
+            return {**self.read_spilled(idx), "idx": idx}
         if self._hack_iter is None or self._hack_next_idx > idx:
+            if self._hack_iter is not None and self.index == "auto":
+                self.index = "always"
             self._hack_iter = iter(self.instance)
             self._hack_next_idx = 0
-        diff = idx - self._hack_next_idx
-        for _ in range(diff):
+            self._buffer.clear()
+        while self._hack_next_idx <= idx:
+            data = next(self._hack_iter)
+            if self.index == "always" and self._hack_next_idx == len(self._offsets):
+                self.spill(data)
+            self.buffer(self._hack_next_idx, data)
             self._hack_next_idx += 1
-            _ = next(self._hack_iter)
-        self._hack_next_idx += 1
-        return {**next(self._hack_iter), "idx": idx}
+        return {**data, "idx": idx}
+
+    def buffer(self, idx, data):
+        self._buffer[idx] = data
+        while len(self._buffer) > self.buffer_size:
+            self._buffer.popitem(last=False)
+
+    def spill(self, data):
+        r"""Appends an element to the index, elements are spilled in order."""
+        if self._spill is None:
+            self._spill = TemporaryFile(dir=self.index_dir)
+        blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        offset = self._spill.seek(0, 2)
+        self._spill.write(blob)
+        self._offsets.append((offset, len(blob)))
+
+    def read_spilled(self, idx):
+        offset, size = self._offsets[idx]
+        if self._mmap is None or len(self._mmap) < offset + size:
+            # The file grew since it was mapped
+            self._spill.flush()
+            if self._mmap is not None:
+                self._mmap.close()
+            self._mmap = mmap.mmap(self._spill.fileno(), 0, access=mmap.ACCESS_READ)
+        return pickle.loads(self._mmap[offset : offset + size])
+
+    def close(self):
+        r"""Removes the index."""
+        if self._mmap is not None:
+            self._mmap.close()
+        if self._spill is not None:
+            self._spill.close()
+        self._spill, self._mmap, self._offsets = None, None, []
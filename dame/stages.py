@@ -1,30 +1,76 @@
+from collections import namedtuple
 from inspect import getfullargspec
+from itertools import chain
+
+
+PlanStep = namedtuple("PlanStep", ["transform", "requires", "provides"])
+PlanStep.__doc__ = """A transform with the exact names of its arguments and outputs."""
 
 
 class Stages:
-    """DAG functionality for Dataset's transforms."""
+    """DAG functionality for Dataset's transforms.
+
+    Keys provided by the reducers are constants for the transforms, they are
+    computed over the whole dataset beforehand, see :class:`dame.reducer.Reducer`.
+    """
 
-    def __init__(self, source, transforms):
+    def __init__(self, source, transforms, reducers=()):
+        self.reducers = tuple(reducers)
+        self.constants = frozenset(kw for r in self.reducers for kw in r.provides)
         self.stages = self.topsort(source, list(transforms))
         self.source = source
+        self.provider.update((kw, r) for r in self.reducers for kw in r.provides)
+        for reducer in self.reducers:
+            assert self.constants.isdisjoint(self.get_requirements(reducer)), (
+                f"{reducer.__name__} can't require results of reducers"
+            )
 
     def get_requirements(self, transform):
-        return getfullargspec(transform.apply)[4]
+        r"""Keyword arguments of transform's apply, inspected once per class.
+
+        Reducers declare their arguments in update.
+        """
+        cls = transform if isinstance(transform, type) else type(transform)
+        requirements = self.__dict__.setdefault("_requirements", {})
+        if cls not in requirements:
+            method = cls.apply if hasattr(cls, "apply") else cls.update
+            requirements[cls] = tuple(getfullargspec(method)[4])
+        return requirements[cls]
+
+    def upstream(self, transform):
+        r"""Providers of transform's arguments.
+
+        Returns:
+            dict: `{keyword: Transform_cls|Reducer_cls|source}`, the index has none
+        """
+        provider = self.__dict__.get("provider", {})
+        source = self.__dict__.get("source", None)
+        result = {}
+        for kw in self.get_requirements(transform):
+            if kw in provider:
+                result[kw] = provider[kw]
+            elif kw in getattr(source, "provides", tuple()):
+                result[kw] = source
+        return result
+
+    def external(self, source):
+        r"""Keys needing no transforms: source's, the index and the constants."""
+        provides = set(getattr(source, "provides", tuple()))
+        return provides | {"idx"} | self.__dict__.get("constants", frozenset())
 
     def topsort(self, source, transforms):
         """Sorts the transforms topologistagcally."""
         provider = {key: t for t in transforms for key in t.provides}
         self.provider = provider
 
+        external = self.external(source)
         dependants = {t: set() for t in transforms}
         for t in transforms:
             for key in self.get_requirements(t):
-                if key not in getattr(source, "provides", tuple()):
+                if key not in external:
                     dependants[provider[key]].add(t)
 
-        requires = {
-            t: set(self.get_requirements(t)) - set(source.provides) for t in transforms
-        }
+        requires = {t: set(self.get_requirements(t)) - external for t in transforms}
         Q = [t for t, deps in requires.items() if len(deps) == 0]
         ordered = []
         while Q:
@@ -45,8 +91,14 @@ class Stages:
         return self.stages[idx]
 
     def to(self, *keywords):
+        r"""Filters the transforms needed to compute the keywords.
+
+        Keywords given by the source (the index and the constants) need no
+        transforms.
+        """
+        external = self.external(self.source)
         result = set()
-        Q = list([self.provider[kw] for kw in keywords])
+        Q = list([self.provider[kw] for kw in keywords if kw not in external])
         while Q:
             t = Q.pop()
             if t not in result:
@@ -55,7 +107,67 @@ class Stages:
                     set(
                         self.provider[kw]
                         for kw in self.get_requirements(t)
-                        if kw not in getattr(self.source, "provides", tuple())
+                        if kw not in external
                     )
                 )
         return filter(lambda t: t in result, self.stages)
+
+    def needs_constants(self, *keywords):
+        r"""Whether the keywords or their plan (see :meth:`plan`) use constants."""
+        return not self.constants.isdisjoint(keywords) or any(
+            not self.constants.isdisjoint(step.requires)
+            for step in self.plan(*keywords)
+        )
+
+    def releases(self, outputs, *keywords):
+        r"""Liveness analysis of the plan for the keywords.
+
+        A key provided by a step is dead right after its last consumer runs, or
+        right after the step if no later step consumes it. Outputs and the index
+        stay alive. Computed once per outputs and keywords.
+
+        Args:
+            outputs (iterable(str)): keywords to keep to the end
+            *keywords (str): see :meth:`plan`
+
+        Returns:
+            tuple(tuple(str)): the keys to release after every step of the plan
+        """
+        releases = self.__dict__.setdefault("_releases", {})
+        key = (frozenset(outputs), frozenset(keywords))
+        if key not in releases:
+            plan, alive = self.plan(*keywords), set(outputs) | {"idx"}
+            last = {}
+            for num, step in enumerate(plan):
+                for kw in chain(step.requires, step.provides):
+                    last[kw] = num
+            releases[key] = tuple(
+                tuple(
+                    kw
+                    for kw in chain(step.requires, step.provides)
+                    if last[kw] == num and kw not in alive
+                )
+                for num, step in enumerate(plan)
+            )
+        return releases[key]
+
+    def plan(self, *keywords):
+        r"""Compiles the execution plan for the keywords.
+
+        The plan is compiled once per set of keywords and reused afterwards.
+
+        Args:
+            *keywords (str): keywords to compute, all transforms if none given
+
+        Returns:
+            tuple(PlanStep): transforms needed for the keywords in topological order
+        """
+        plans = self.__dict__.setdefault("_plans", {})
+        key = frozenset(keywords)
+        if key not in plans:
+            transforms = self.to(*keywords) if keywords else iter(self)
+            plans[key] = tuple(
+                PlanStep(t, self.get_requirements(t), tuple(t.provides))
+                for t in transforms
+            )
+        return plans[key]
@@ -1,7 +1,20 @@
+from contextlib import ExitStack
 from datetime import datetime
+from hashlib import blake2b
 from io import BytesIO
+from queue import Empty
+from tempfile import mkstemp
+from threading import Lock, get_ident
+from time import monotonic
+from weakref import WeakKeyDictionary, WeakValueDictionary
+import os
 import pickle
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
 import numpy as np
 from peewee import (
     Model,
@@ -9,10 +22,18 @@ from peewee import (
     ForeignKeyField,
     DateTimeField,
     BlobField,
+    CharField,
     IntegerField,
     SqliteDatabase,
+    JOIN,
+    chunked,
+    fn,
 )
 
+from playhouse.migrate import SchemaMigrator, migrate
+
+from . import compression, serialization
+
 
 class TransformModel(Model):
     name = FixedCharField(max_length=128)
@@ -20,92 +41,868 @@ class TransformModel(Model):
     version = DateTimeField(default=datetime.now)
 
 
+class Blob(Model):
+    r"""A stored payload, shared by all the results with the same content."""
+
+    hash = CharField(max_length=64, unique=True)
+    pickled_data = BlobField()
+    numpy_data = BlobField(null=True)
+    codec = CharField(max_length=16, null=True)
+
+
 class Result(Model):
+    r"""A result, its payload is either in the row or in the blob it points to."""
+
     origin = ForeignKeyField(TransformModel, backref="results")
     dataset_index = IntegerField()
     pickled_data = BlobField()
     numpy_data = BlobField(null=True)
+    codec = CharField(max_length=16, null=True)
+    blob = ForeignKeyField(Blob, null=True, backref="results")
+
+    class Meta:
+        indexes = ((("origin", "dataset_index"), True),)
+
+    @staticmethod
+    def select_payloads(*fields):
+        r"""Selects the fields with the payloads of the results and their blobs."""
+        return Result.select(
+            *fields,
+            Result.pickled_data,
+            Result.numpy_data,
+            Result.codec,
+            Blob.id,
+            Blob.pickled_data,
+            Blob.numpy_data,
+            Blob.codec,
+        ).join(Blob, JOIN.LEFT_OUTER)
+
+    def payload(self):
+        r"""(pickled_data, numpy_data, codec) of a row from :meth:`select_payloads`."""
+        blob = self.__rel__.get("blob")
+        row = self if blob is None or blob.id is None else blob
+        return row.pickled_data, row.numpy_data, row.codec
 
 
 class NumpyPlaceholder:
+    r"""Marks a top-level array in results saved by older versions of dame."""
+
     def __init__(self, num):
         self.num = num
 
 
+class Snapshot:
+    r"""Stored results of several transforms for a group of indices.
+
+    Made by :meth:`PeeWeeStore.snapshot` with a single query. The blobs are either
+    fetched with it or later (see :meth:`fetch`) and unpacked only when loaded.
+    """
+
+    def __init__(self, store, ids, blobs):
+        self.store = store
+        self.ids = ids
+        self.blobs = blobs
+
+    def key(self, idx, transform):
+        return self.store.transform_id(transform), idx
+
+    def __contains__(self, item):
+        return self.key(*item) in self.ids
+
+    def fetch(self, items):
+        r"""Fetches the blobs of (idx, transform) items in one query."""
+        keys = [self.key(*item) for item in items]
+        ids = {self.ids[k]: k for k in keys if k in self.ids and k not in self.blobs}
+        if not ids:
+            return
+        query = Result.select_payloads(Result.id).where(
+            Result.id.in_(list(ids))
+        )
+        for res in query:
+            self.blobs[ids[res.id]] = res.payload()
+
+    def load(self, idx, transform):
+        key = self.key(idx, transform)
+        if key not in self.ids:
+            return None
+        if key not in self.blobs:
+            self.fetch([(idx, transform)])
+        return self.store.unpack_blobs(*self.blobs[key])
+
+
 class PeeWeeStore:
-    def __init__(self, transforms, db_cls=SqliteDatabase, db_args=(), db_kwargs=None):
+    r"""Stores results of transforms in a database.
+
+    Saved results are buffered and written (upserted) in a single transaction once
+    flush_size of them are pending or flush_interval seconds passed since the last
+    write, and on :meth:`flush` / :meth:`close`. Pending results can be loaded.
+
+    Args:
+        transforms (iterable(Transform)): transforms to register upfront
+        db_cls (peewee.Database): Defaults to SqliteDatabase.
+        db_args (tuple): args of db_cls
+        db_kwargs (dict): kwargs of db_cls
+        flush_size (int): Defaults to 256.
+        flush_interval (float): Defaults to 1 second.
+        wal (bool): Switch a SQLite database to write-ahead logging, so that
+            readers don't block the writer. Defaults to False.
+        writer_queue (Queue, optional): Flushed results are sent through the queue
+            to a single writer (see :meth:`serve`) instead of being written. The
+            store only reads then, the tables and the versions of the transforms
+            it saves must be made upfront, see :meth:`transform_id`.
+        dedup (bool): Store every distinct payload once, in a table of blobs keyed
+            by its hash. Results with an already stored payload only point to it.
+            Defaults to True.
+        codecs (dict, optional): Compression of the results, `{transform name:
+            codec}`, "*" for all the other transforms. A codec is a name (see
+            :mod:`dame.compression`) or `{key: name}` to compress values of
+            some keys on their own, "*" then compresses the whole result. A
+            transform may declare its codec in a codec attribute. The codec is
+            recorded with each result, changing it keeps old results readable.
+    """
+
+    # Stores opened by threads of a process share the database object, peewee
+    # keeps a separate connection for every thread.
+    _databases = WeakValueDictionary()
+    _databases_lock = Lock()
+
+    def __init__(
+        self,
+        transforms,
+        db_cls=SqliteDatabase,
+        db_args=(),
+        db_kwargs=None,
+        flush_size=256,
+        flush_interval=1.0,
+        wal=False,
+        writer_queue=None,
+        dedup=True,
+        codecs=None,
+    ):
         self.transforms = transforms
         self.db_cls, self.db_args = db_cls, db_args
         self.db_kwargs = db_kwargs or dict({"pragmas": {"foreign_keys": 1}})
+        self.flush_size, self.flush_interval = flush_size, flush_interval
+        self.wal, self.writer_queue = wal, writer_queue
+        self.dedup, self.codecs = dedup, codecs or {}
+        self.pending = {}
+        self.last_flush = monotonic()
 
     def open(self, *args, **kwargs):
         if not args:
             args = self.db_args
         if not kwargs:
             kwargs = self.db_kwargs
-        self.db = self.db_cls(*args, **kwargs)
+        key = (os.getpid(), self.db_cls, tuple(args), repr(kwargs))
+        with self._databases_lock:
+            self.db = self._databases.get(key, None)
+            if self.db is None:
+                self.db = self._databases[key] = self.db_cls(*args, **kwargs)
         # Models in relation are automatically bound
         TransformModel.bind(self.db)
-        self.db.connect()
-        self.db.create_tables([TransformModel, Result])
+        self.db.connect(reuse_if_open=True)
+        if isinstance(self.db, SqliteDatabase):
+            # Of this thread's connection, the threads share the database object
+            self.db.pragma("query_only", int(self.read_only))
+        if self.read_only:
+            return
+        if self.wal and isinstance(self.db, SqliteDatabase):
+            self.db.pragma("journal_mode", "wal")
+        self.db.create_tables([TransformModel, Blob])
+        # Before the indexes of Result, SQLite would index missing columns as strings
+        self.migrate()
+        self.db.create_tables([Result])
+
+    @property
+    def read_only(self):
+        r"""Whether the results go to a writer, see ``writer_queue``."""
+        return self.writer_queue is not None
+
+    def migrate(self):
+        r"""Upgrades databases made by older versions of dame.
+
+        Adds the missing columns and, before the unique index on (origin,
+        dataset_index) is created, keeps only the newest of duplicate results
+        (older versions inserted without upserting).
+        """
+        table = Result._meta.table_name
+        if not self.db.table_exists(table):
+            return
+        columns = {column.name for column in self.db.get_columns(table)}
+        migrator = SchemaMigrator.from_database(self.db)
+        for field in (Result.codec, Result.blob):
+            if field.column_name not in columns:
+                migrate(migrator.add_column(table, field.column_name, field))
+        unique = [index.columns for index in self.db.get_indexes(table) if index.unique]
+        if ["origin_id", "dataset_index"] not in unique:
+            newest = Result.select(fn.MAX(Result.id)).group_by(
+                Result.origin, Result.dataset_index
+            )
+            Result.delete().where(Result.id.not_in(newest)).execute()
 
     def close(self):
+        self.flush()
         self.db.close()
 
+    def flush(self):
+        r"""Writes all the pending results in a single transaction."""
+        rows, self.pending = list(self.pending.values()), {}
+        self.last_flush = monotonic()
+        if not rows:
+            return
+        if self.writer_queue is not None:
+            self.writer_queue.put(rows)
+            return
+        with self.write_transaction():
+            blob_ids = self.write_blobs([row for row in rows if row.get("hash")])
+            rows = [self.result_row(row, blob_ids) for row in rows]
+            # Stays below the SQLite limit on variables in a query
+            for batch in chunked(rows, 100):
+                Result.insert_many(batch).on_conflict(
+                    conflict_target=[Result.origin, Result.dataset_index],
+                    preserve=[
+                        Result.pickled_data,
+                        Result.numpy_data,
+                        Result.codec,
+                        Result.blob,
+                    ],
+                ).execute()
+
+    def write_transaction(self):
+        r"""A transaction that takes the write lock of SQLite upfront.
+
+        In a deferred transaction the first read takes a shared lock, SQLite fails
+        to upgrade it (without waiting for the busy timeout) while another
+        connection writes.
+        """
+        if isinstance(self.db, SqliteDatabase):
+            return self.db.atomic("IMMEDIATE")
+        return self.db.atomic()
+
+    @staticmethod
+    def blob_ids(hashes):
+        r"""Ids of the stored blobs among the hashes, keyed by hash."""
+        ids = {}
+        # Stays below the SQLite limit on variables in a query
+        for batch in chunked(hashes, 100):
+            query = Blob.select(Blob.hash, Blob.id).where(Blob.hash.in_(batch))
+            ids.update(query.tuples())
+        return ids
+
+    def write_blobs(self, rows):
+        r"""Writes the payloads of the rows, except those already stored (even by
+        other stores writing at the same time).
+
+        Returns:
+            dict: ids of the blobs keyed by their hashes
+        """
+        payloads = {row["hash"]: row for row in rows}
+        ids = self.blob_ids(list(payloads))
+        missing = [digest for digest in payloads if digest not in ids]
+        for batch in chunked(missing, 100):
+            Blob.insert_many(
+                {
+                    "hash": digest,
+                    "pickled_data": payloads[digest]["pickled_data"],
+                    "numpy_data": payloads[digest]["numpy_data"],
+                    "codec": payloads[digest]["codec"],
+                }
+                for digest in batch
+            ).on_conflict_ignore().execute()
+        # Blobs another store wrote since the lookup are kept, their ids selected
+        return {**ids, **self.blob_ids(missing)}
+
+    @staticmethod
+    def result_row(row, blob_ids):
+        r"""The Result row of a row from :meth:`make_row`."""
+        result = {
+            "origin": row["origin"],
+            "dataset_index": row["dataset_index"],
+            "pickled_data": row["pickled_data"],
+            "numpy_data": row["numpy_data"],
+            "codec": row["codec"],
+            "blob": None,
+        }
+        if row.get("hash"):
+            blob = blob_ids[row["hash"]]
+            result.update(pickled_data=b"", numpy_data=None, codec=None, blob=blob)
+        return result
+
+    @staticmethod
+    def payload_hash(pickled_data, numpy_data, codec):
+        r"""Hex digest (BLAKE2b) of a stored payload, codec included."""
+        digest = blake2b(digest_size=32)
+        for part in (codec.encode() if codec else b"", pickled_data, numpy_data or b""):
+            digest.update(len(part).to_bytes(8, "little"))
+            digest.update(part)
+        return digest.hexdigest()
+
     @property
     def transform_ids(self):
+        r"""Ids of the registered transforms keyed by (name, digest)."""
         if not hasattr(self, "_transform_ids"):
-            self._transform_ids = {
-                t.__class__.__name__: TransformModel.get_or_create(
-                    digest=t.version(), name=t.__class__.__name__
-                )[0].id
-                for t in self.transforms
-            }
+            self._transform_ids, self._instance_ids = {}, WeakKeyDictionary()
+            for t in self.transforms:
+                self.transform_id(t)
         return self._transform_ids
 
+    def transform_id(self, transform):
+        r"""Id of the transform's current version, registered on first use.
+
+        Instances of a transform with different versions (e.g. with different
+        arguments) get different ids. The version of an instance is computed once.
+
+        Raises:
+            LookupError: if the store is read-only and the version is not registered
+        """
+        ids = self.transform_ids
+        if transform not in self._instance_ids:
+            name, digest = transform.__class__.__name__, transform.version()
+            if (name, digest) not in ids and self.read_only:
+                version = TransformModel.get_or_none(digest=digest, name=name)
+                if version is None:
+                    raise LookupError(
+                        f"Version {digest} of {name} is not registered, the store "
+                        "is read-only"
+                    )
+                ids[name, digest] = version.id
+            elif (name, digest) not in ids:
+                ids[name, digest] = TransformModel.get_or_create(
+                    digest=digest, name=name
+                )[0].id
+            self._instance_ids[transform] = ids[name, digest]
+        return self._instance_ids[transform]
+
     @staticmethod
-    def separate_numpy_data(data):
-        np_data = []
-        for key in sorted(data.keys()):
-            if isinstance(data[key], np.ndarray):
-                np_data.append(data[key])
-                data[key] = NumpyPlaceholder(len(np_data) - 1)
-        return data, np_data
+    def get_blobs(data):
+        r"""Pickles data, the numpy arrays (at any depth) go to a separate frame.
+
+        Returns:
+            tuple(bytes, bytes|None): the pickle and the frame of arrays' buffers
+        """
+        return serialization.frame(data)
 
     @staticmethod
-    def get_blobs(data, np_data):
-        out = pickle.dumps(data)
-        if len(np_data) > 0:
-            np_out = BytesIO()
-            for arr in np_data:
-                np.save(np_out, arr)
-            return out, np_out.getvalue()
-        return out, None
+    def unpack_blobs(data_blob, np_data_blob, codec=None):
+        if codec is not None:
+            data_blob = compression.decompress(codec, data_blob)
+            if np_data_blob is not None:
+                np_data_blob = compression.decompress(codec, np_data_blob)
+        if np_data_blob is not None and not serialization.is_packed(np_data_blob):
+            return PeeWeeStore.unpack_legacy_blobs(data_blob, np_data_blob)
+        if np_data_blob is not None:
+            # The loaded arrays are views of the frame: one copy makes them writable
+            np_data_blob = bytearray(np_data_blob)
+        return compression.decompress_values(
+            serialization.unframe((data_blob, np_data_blob))
+        )
+
+    def codec(self, transform):
+        r"""Codec of transform's results: a name or `{key: name}`, see ``codecs``."""
+        name = transform.__class__.__name__
+        if name in self.codecs:
+            return self.codecs[name]
+        return getattr(transform, "codec", self.codecs.get("*", None))
+
+    def compress(self, transform, data):
+        r"""Compresses the values of data with per-key codecs.
+
+        Returns:
+            tuple(dict, str|None): data and the codec of the whole row
+        """
+        codec = self.codec(transform)
+        if not isinstance(codec, dict):
+            return data, codec
+        per_key = {key: name for key, name in codec.items() if key != "*"}
+        return compression.compress_values(data, per_key), codec.get("*", None)
 
     @staticmethod
-    def unpack_blobs(data_blob, np_data_blob):
+    def unpack_legacy_blobs(data_blob, np_data_blob):
+        r"""Reads results saved with top-level arrays as NumpyPlaceholders."""
         data = pickle.loads(data_blob)
-        if np_data_blob is not None:
-            ord_keys = [i for i in data.items() if isinstance(i[1], NumpyPlaceholder)]
-            ord_keys = sorted(ord_keys, key=lambda item: item[1].num)
-            ord_keys, _ = zip(*ord_keys)
-            np_data_blob = BytesIO(np_data_blob)
-            for key in ord_keys:
-                data[key] = np.load(np_data_blob)
+        ord_keys = [i for i in data.items() if isinstance(i[1], NumpyPlaceholder)]
+        ord_keys = sorted(ord_keys, key=lambda item: item[1].num)
+        ord_keys, _ = zip(*ord_keys)
+        np_data_blob = BytesIO(np_data_blob)
+        for key in ord_keys:
+            data[key] = np.load(np_data_blob)
         return data
 
+    def serve(self, queue):
+        r"""Writes the rows other stores flush to the queue, until None is received.
+
+        Rows are written in batches, like the results saved to this store.
+        """
+        while True:
+            try:
+                waited = monotonic() - self.last_flush
+                rows = queue.get(
+                    timeout=max(0, self.flush_interval - waited) if self.pending else None
+                )
+            except Empty:
+                self.flush()
+                continue
+            if rows is None:
+                return
+            for row in rows:
+                self.pending[(row["origin"], row["dataset_index"])] = row
+            if (
+                len(self.pending) >= self.flush_size
+                or monotonic() - self.last_flush >= self.flush_interval
+            ):
+                self.flush()
+
+    def make_row(self, idx, transform, data):
+        data, codec = self.compress(transform, data)
+        out, np_out = self.get_blobs(data)
+        if codec is not None:
+            out = compression.compress(codec, out)
+            if np_out is not None:
+                np_out = compression.compress(codec, np_out)
+        return {
+            "origin": self.transform_id(transform),
+            "dataset_index": idx,
+            "pickled_data": out,
+            "numpy_data": np_out,
+            "codec": codec,
+            "hash": self.payload_hash(out, np_out, codec) if self.dedup else None,
+        }
+
     def save(self, idx, transform, data):
-        data = dict(data)
-        out, np_out = self.get_blobs(*self.separate_numpy_data(data))
-        trans = self.transform_ids[transform.__class__.__name__]
-        res = Result(
-            origin_id=trans, dataset_index=idx, pickled_data=out, numpy_data=np_out,
-        )
-        res.save()
+        self.save_many([idx], transform, [data])
 
     def load(self, idx, transform):
-        trans = self.transform_ids[transform.__class__.__name__]
-        res = Result.get_or_none(origin_id=trans, dataset_index=idx)
-        if res is None:
-            return None
-        return self.unpack_blobs(res.pickled_data, res.numpy_data)
+        return self.load_many([idx], transform)[0]
+
+    def save_many(self, idxs, transform, datas):
+        r"""Saves results of a transform for a batch of indices."""
+        for idx, data in zip(idxs, datas):
+            row = self.make_row(idx, transform, data)
+            self.pending[(row["origin"], idx)] = row
+        if (
+            len(self.pending) >= self.flush_size
+            or monotonic() - self.last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def load_many(self, idxs, transform):
+        r"""Loads results of a transform for a batch of indices in one query.
+
+        Returns:
+            list(dict|None): results aligned with idxs, None where not stored
+        """
+        snapshot = self.snapshot(idxs, [transform])
+        return [snapshot.load(idx, transform) for idx in idxs]
+
+    def snapshot(self, idxs, transforms, blobs=True):
+        r"""Fetches the stored results of all the transforms for idxs in one query.
+
+        Args:
+            idxs (list(int)): dataset indices, a contiguous range is queried as such
+            transforms (iterable(Transform)): transforms whose results to fetch
+            blobs (bool): if False only which results are stored is fetched, blobs
+                are fetched on demand. Defaults to True.
+
+        Returns:
+            Snapshot: the results found in the store
+        """
+        origins = [self.transform_id(t) for t in transforms]
+        idxs = sorted(set(idxs))
+        if not origins or not idxs:
+            return Snapshot(self, {}, {})
+        if idxs[-1] - idxs[0] + 1 == len(idxs):
+            in_idxs = Result.dataset_index.between(idxs[0], idxs[-1])
+        else:
+            in_idxs = Result.dataset_index.in_(idxs)
+        fields = [Result.id, Result.origin, Result.dataset_index]
+        query = Result.select_payloads(*fields) if blobs else Result.select(*fields)
+        query = query.where(Result.origin.in_(origins) & in_idxs)
+        ids, fetched = {}, {}
+        for res in query:
+            key = (res.origin_id, res.dataset_index)
+            ids[key] = res.id
+            if blobs:
+                fetched[key] = res.payload()
+        for origin in origins:
+            for idx in idxs:
+                row = self.pending.get((origin, idx), None)
+                if row is not None:
+                    ids[(origin, idx)] = None
+                    fetched[(origin, idx)] = (
+                        row["pickled_data"],
+                        row["numpy_data"],
+                        row["codec"],
+                    )
+        return Snapshot(self, ids, fetched)
+
+    def versions(self):
+        r"""Stored transform versions with the number and size of their results.
+
+        Returns:
+            list(dict): id, name, digest, created, results and nbytes of every
+                version, oldest first. A blob shared by several versions counts
+                in each of them, see :meth:`exclusive_nbytes`.
+        """
+        self.flush()
+        nbytes = fn.SUM(
+            fn.LENGTH(Result.pickled_data)
+            + fn.COALESCE(fn.LENGTH(Result.numpy_data), 0)
+            + fn.COALESCE(fn.LENGTH(Blob.pickled_data), 0)
+            + fn.COALESCE(fn.LENGTH(Blob.numpy_data), 0)
+        )
+        query = (
+            TransformModel.select(
+                TransformModel,
+                fn.COUNT(Result.id).alias("results"),
+                fn.COALESCE(nbytes, 0).alias("nbytes"),
+            )
+            .join(Result, JOIN.LEFT_OUTER)
+            .join(Blob, JOIN.LEFT_OUTER)
+            .group_by(TransformModel.id)
+            .order_by(TransformModel.version, TransformModel.id)
+        )
+        return [
+            {
+                "id": version.id,
+                "name": version.name.strip(),
+                "digest": version.digest.strip(),
+                "created": version.version,
+                "results": version.results,
+                "nbytes": version.nbytes,
+            }
+            for version in query
+        ]
+
+    def exclusive_nbytes(self, ids=None):
+        r"""Size of the results of versions, every blob counted once.
+
+        Args:
+            ids (iterable(int), optional): ids of the versions, defaults to all
+
+        Returns:
+            int: bytes of their rows and of the blobs no other version shares, the
+                bytes deleting them frees
+        """
+        self.flush()
+        results = Result.select(Result.blob).where(Result.blob.is_null(False))
+        result_bytes = Result.select(
+            fn.SUM(
+                fn.LENGTH(Result.pickled_data)
+                + fn.COALESCE(fn.LENGTH(Result.numpy_data), 0)
+            )
+        )
+        blob_bytes = Blob.select(
+            fn.SUM(
+                fn.LENGTH(Blob.pickled_data)
+                + fn.COALESCE(fn.LENGTH(Blob.numpy_data), 0)
+            )
+        )
+        if ids is not None:
+            ids = list(ids)
+            result_bytes = result_bytes.where(Result.origin.in_(ids))
+            blob_bytes = blob_bytes.where(
+                Blob.id.in_(results.where(Result.origin.in_(ids)))
+                & Blob.id.not_in(results.where(Result.origin.not_in(ids)))
+            )
+        return (result_bytes.scalar() or 0) + (blob_bytes.scalar() or 0)
+
+    def delete_versions(self, ids):
+        r"""Deletes transform versions with all their results and orphaned blobs.
+
+        Returns:
+            int: number of deleted results
+        """
+        self.flush()
+        deleted = 0
+        with self.db.atomic():
+            for batch in chunked(ids, 100):
+                deleted += Result.delete().where(Result.origin.in_(batch)).execute()
+                TransformModel.delete().where(TransformModel.id.in_(batch)).execute()
+            self.delete_orphan_blobs()
+        ids = set(ids)
+        for key in [k for k, v in self.transform_ids.items() if v in ids]:
+            del self._transform_ids[key]
+        for transform in [t for t, v in self._instance_ids.items() if v in ids]:
+            del self._instance_ids[transform]
+        return deleted
+
+    @staticmethod
+    def delete_orphan_blobs():
+        r"""Deletes the blobs no result points to.
+
+        Returns:
+            int: number of deleted blobs
+        """
+        referenced = Result.select(Result.blob).where(Result.blob.is_null(False))
+        return Blob.delete().where(Blob.id.not_in(referenced)).execute()
+
+    def size(self):
+        r"""Size of the database files in bytes, 0 if they are not files."""
+        path = getattr(self.db, "database", None)
+        if not isinstance(self.db, SqliteDatabase) or path == ":memory:":
+            return 0
+        return sum(
+            os.path.getsize(p) for p in (path, f"{path}-wal") if os.path.exists(p)
+        )
+
+    def compact(self):
+        r"""Rewrites the database file without the pages of deleted results.
+
+        SQLite only (VACUUM), other databases are left as they are. Other
+        connections may read while the database is rewritten.
+
+        Returns:
+            int: bytes reclaimed
+        """
+        self.flush()
+        self.delete_orphan_blobs()
+        if not isinstance(self.db, SqliteDatabase):
+            return 0
+        before = self.size()
+        self.db.execute_sql("VACUUM")
+        if self.db.pragma("journal_mode") == "wal":
+            self.db.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        return max(0, before - self.size())
+
+
+class MmapStore(PeeWeeStore):
+    r"""Keeps numpy arrays in append-only files, the database only references them.
+
+    Arrays (at any depth of the results) are appended, aligned, to shard files, one
+    per transform version and writing thread (new ones every time the store is
+    opened), in array_dir. Loaded arrays are read-only views of memory maps of those
+    files: reading them costs no copy. Codecs compress the rest of the results, the
+    arrays stay raw. Results are not deduplicated, the database rows only hold
+    references to the shards. Their codec column tells them apart from rows of
+    :class:`PeeWeeStore`: "mmap" or "mmap:<codec>".
+
+    Args:
+        transforms (iterable(Transform)): see :class:`PeeWeeStore`
+        array_dir (str, optional): Defaults to the database path + ".arrays".
+        alignment (int): Alignment of arrays in the files. Defaults to 64.
+        **kwargs: see :class:`PeeWeeStore`
+    """
+
+    row_format = "mmap"
+
+    def __init__(self, transforms, array_dir=None, alignment=64, **kwargs):
+        super().__init__(transforms, **kwargs)
+        self.array_dir, self.alignment = array_dir, alignment
+        self.shards, self.maps = {}, {}
+
+    def open(self, *args, **kwargs):
+        super().open(*args, **kwargs)
+        if self.array_dir is None:
+            self.array_dir = f"{self.db.database}.arrays"
+        os.makedirs(self.array_dir, exist_ok=True)
+
+    def close(self):
+        super().close()
+        for shard in self.shards.values():
+            shard.close()
+        self.shards = {}
+
+    def shard(self, origin):
+        key = (origin, os.getpid(), get_ident())
+        if key not in self.shards:
+            # A new file every time: the files compaction removes are never reopened
+            fd, path = mkstemp(".bin", "{}-{}-{}-".format(*key), self.array_dir)
+            os.close(fd)
+            shard = open(path, "ab")
+            if fcntl is not None:
+                # Held as long as the shard is appended to, see rewrite_shards
+                fcntl.flock(shard, fcntl.LOCK_SH)
+            self.shards[key] = shard
+        return self.shards[key]
+
+    def write_buffers(self, origin, buffers):
+        r"""Appends the buffers to a shard file.
+
+        Returns:
+            list(tuple): (file name, offset, size) of every buffer
+        """
+        return self.append_buffers(self.shard(origin), buffers)
+
+    def append_buffers(self, shard, buffers):
+        name = os.path.basename(shard.name)
+        refs = []
+        for buffer in buffers:
+            shard.write(b"\0" * (-shard.tell() % self.alignment))
+            refs.append((name, shard.tell(), buffer.nbytes))
+            shard.write(buffer)
+        # Readers in other processes may see the row as soon as it is written
+        shard.flush()
+        return refs
+
+    def make_row(self, idx, transform, data):
+        data, codec = self.compress(transform, data)
+        data, buffers = serialization.dumps(data)
+        if codec is not None:
+            # The arrays stay raw, to be mapped
+            data = compression.compress(codec, data)
+        origin = self.transform_id(transform)
+        return {
+            "origin": origin,
+            "dataset_index": idx,
+            "pickled_data": data,
+            "numpy_data": pickle.dumps(self.write_buffers(origin, buffers)),
+            "codec": self.row_format if codec is None else f"{self.row_format}:{codec}",
+        }
+
+    def shard_files(self, origin):
+        prefix = f"{origin}-"
+        return [
+            os.path.join(self.array_dir, name)
+            for name in os.listdir(self.array_dir)
+            if name.startswith(prefix) and name.endswith(".bin")
+        ]
+
+    def versions(self):
+        r"""See :meth:`PeeWeeStore.versions`, nbytes include the shard files."""
+        versions = super().versions()
+        for version in versions:
+            version["nbytes"] += sum(
+                os.path.getsize(path) for path in self.shard_files(version["id"])
+            )
+        return versions
+
+    def exclusive_nbytes(self, ids=None):
+        r"""See :meth:`PeeWeeStore.exclusive_nbytes`, includes the shard files."""
+        if ids is None:
+            origins = [version.id for version in TransformModel.select()]
+        else:
+            origins = ids = list(ids)
+        paths = [path for origin in origins for path in self.shard_files(origin)]
+        return super().exclusive_nbytes(ids) + sum(map(os.path.getsize, paths))
+
+    def delete_versions(self, ids):
+        r"""See :meth:`PeeWeeStore.delete_versions`, removes the shard files too."""
+        deleted = super().delete_versions(ids)
+        for origin in ids:
+            for key in [k for k in self.shards if k[0] == origin]:
+                self.shards.pop(key).close()
+            for path in self.shard_files(origin):
+                self.maps.pop(os.path.basename(path), None)
+                os.remove(path)
+        return deleted
+
+    def size(self):
+        r"""See :meth:`PeeWeeStore.size`, includes the shard files."""
+        return super().size() + sum(
+            os.path.getsize(os.path.join(self.array_dir, name))
+            for name in os.listdir(self.array_dir)
+        )
+
+    def compact(self):
+        r"""See :meth:`PeeWeeStore.compact`, also rewrites the shard files holding
+        arrays no result references any more (e.g. of replaced results).
+
+        Other stores may keep writing meanwhile: the shards they append to are left as
+        they are, see :meth:`rewrite_shards`. Readers keep the maps of the replaced
+        files.
+
+        Returns:
+            int: bytes reclaimed
+        """
+        self.flush()
+        before = self.size()
+        for shard in self.shards.values():
+            shard.close()
+        self.shards = {}
+        for version in TransformModel.select():
+            self.rewrite_shards(version.id)
+        super().compact()
+        return max(0, before - self.size())
+
+    def rewrite_shards(self, origin):
+        r"""Copies the referenced arrays of a version to a new shard file.
+
+        Only closed shards are rewritten: writers hold a shared lock on their shard
+        until they close it, the shards that cannot be locked exclusively are skipped.
+        Shards without unreferenced regions (padding aside) are left as they are.
+        Without file locks (i.e. on Windows), no shard is rewritten.
+
+        Note:
+            With a single writer, the rows of a shard may still be queued once its
+            worker closed it, compact when no computation runs.
+        """
+        if fcntl is None:
+            return
+        with ExitStack() as stack:
+            closed = {}
+            for path in self.shard_files(origin):
+                try:
+                    shard = stack.enter_context(open(path, "rb"))
+                    fcntl.flock(shard, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (BlockingIOError, FileNotFoundError):
+                    # Still appended to, or removed by another compaction
+                    continue
+                if os.path.exists(path):
+                    closed[os.path.basename(path)] = path
+            if not closed:
+                return
+            # Takes the write lock before reading: no row changes in between, and
+            # other compactions only weigh the new shard once it is referenced
+            with self.write_transaction():
+                rows = (
+                    Result.select(Result.id, Result.numpy_data)
+                    .where(
+                        (Result.origin == origin)
+                        & (
+                            (Result.codec == self.row_format)
+                            | Result.codec.startswith(f"{self.row_format}:")
+                        )
+                    )
+                    .tuples()
+                )
+                live = dict.fromkeys(closed, 0)
+                refs = {}
+                for id_, numpy_data in rows:
+                    row = pickle.loads(numpy_data)
+                    # The arrays of a row are in a single shard
+                    if row and row[0][0] in closed:
+                        refs[id_] = row
+                        live[row[0][0]] += sum(size for *_, size in row)
+                        live[row[0][0]] += self.alignment * len(row)
+                old = {
+                    name
+                    for name, path in closed.items()
+                    if os.path.getsize(path) > live[name]
+                }
+                refs = {id_: row for id_, row in refs.items() if row[0][0] in old}
+                if refs:
+                    fd, path = mkstemp(".bin", f"{origin}-c", self.array_dir)
+                    os.close(fd)
+                    with open(path, "wb") as new_shard:
+                        for id_, row in refs.items():
+                            buffers = [self.view(*ref) for ref in row]
+                            moved = self.append_buffers(new_shard, buffers)
+                            Result.update(numpy_data=pickle.dumps(moved)).where(
+                                Result.id == id_
+                            ).execute()
+            for name in old:
+                self.maps.pop(name, None)
+                os.remove(closed[name])
+
+    def view(self, name, offset, size):
+        r"""A read-only view of a shard file, mapped to memory."""
+        if size == 0:
+            return memoryview(b"")
+        mapped = self.maps.get(name, None)
+        if mapped is None or len(mapped) < offset + size:
+            # The shard grew since it was mapped
+            mapped = np.memmap(os.path.join(self.array_dir, name), np.uint8, "r")
+            self.maps[name] = mapped
+        return memoryview(mapped[offset : offset + size])
+
+    def unpack_blobs(self, data_blob, np_data_blob, codec=None):
+        row_format, _, inner_codec = (codec or "").partition(":")
+        if row_format != self.row_format:
+            # Saved by PeeWeeStore
+            return PeeWeeStore.unpack_blobs(data_blob, np_data_blob, codec)
+        if inner_codec:
+            data_blob = compression.decompress(inner_codec, data_blob)
+        refs = pickle.loads(np_data_blob)
+        return compression.decompress_values(
+            serialization.loads(data_blob, [self.view(*ref) for ref in refs])
+        )
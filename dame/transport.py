@@ -0,0 +1,161 @@
+from multiprocessing import Array
+from multiprocessing.shared_memory import SharedMemory
+from weakref import finalize
+
+import numpy as np
+
+from . import serialization
+
+
+class SharedMemoryTransport:
+    r"""Sends large arrays from pool workers to the parent through shared memory.
+
+    Results are pickled with protocol 5 (see :mod:`dame.serialization`). Each
+    out-of-band buffer of at least threshold bytes is copied by the worker into a
+    free segment of a pool of shared memory segments, only its descriptor goes
+    through the pipe. The parent rebuilds the arrays as zero-copy views of the
+    segments. A segment is recycled once every array viewing it is garbage
+    collected. If no segment is free (or the buffer does not fit), the buffer is
+    sent through the pipe.
+
+    Each computation is a run (see :meth:`receiving`), the segments of its results
+    that are never received (e.g. of an abandoned iteration, whose remaining items
+    are still computed) are recycled once the run is closed.
+
+    Args:
+        segments (int): Number of segments. Defaults to 32.
+        segment_size (int): Size of a segment in bytes. Defaults to 16 MiB.
+        threshold (int): Smaller buffers go through the pipe. Defaults to 64 KiB.
+    """
+
+    def __init__(self, segments=32, segment_size=2 ** 24, threshold=2 ** 16):
+        self.n_segments, self.segment_size = segments, segment_size
+        self.threshold = threshold
+        self.segments = None
+        self.open_runs, self.last_run = set(), 0
+
+    def start(self):
+        r"""Creates the segments, called in the parent before the workers start."""
+        self.segments = [
+            SharedMemory(create=True, size=self.segment_size)
+            for _ in range(self.n_segments)
+        ]
+        # Run of the result in each segment, shared with the workers: 0 if free,
+        # negative while the worker copies the result
+        self.owners = Array("i", self.n_segments)
+        self.leased = set()
+
+    def close(self):
+        r"""Removes the segments, arrays still viewing them stay valid.
+
+        A segment viewed by arrays is closed once they are all collected.
+        """
+        for segment in self.segments or ():
+            segment.unlink()
+            if segment not in self.leased:
+                segment.close()
+        self.segments = None
+
+    def take(self, run):
+        r"""Marks a free segment as being written for a run.
+
+        Returns:
+            int: its number or None if no segment is free
+        """
+        with self.owners.get_lock():
+            owners = self.owners.get_obj()
+            for num, owner in enumerate(owners):
+                if owner == 0:
+                    owners[num] = -run
+                    return num
+        return None
+
+    def release(self, num, segment):
+        r"""Recycles a segment no array views, closes it after :meth:`close`."""
+        self.leased.discard(segment)
+        if self.segments is not None and self.segments[num] is segment:
+            self.owners[num] = 0
+        else:
+            segment.close()
+
+    def open_run(self):
+        r"""Starts a run in the parent.
+
+        Returns:
+            int: its number, for :meth:`send`
+        """
+        self.last_run += 1
+        self.open_runs.add(self.last_run)
+        return self.last_run
+
+    def close_run(self, run):
+        r"""Ends a run, the segments of its results never received are recycled."""
+        self.open_runs.discard(run)
+        self.reclaim()
+
+    def reclaim(self):
+        r"""Recycles the written segments of closed runs that the parent didn't
+        receive. Segments still being written are left to a later call.
+        """
+        if self.segments is None:
+            return
+        leased = [segment in self.leased for segment in self.segments]
+        with self.owners.get_lock():
+            owners = self.owners.get_obj()
+            for num, owner in enumerate(owners):
+                if owner > 0 and owner not in self.open_runs and not leased[num]:
+                    owners[num] = 0
+
+    def send(self, obj, run):
+        r"""Pickles obj in a worker, large buffers are copied to free segments.
+
+        Returns:
+            tuple(bytes, list): the pickle and, for every buffer, either its bytes
+                or the (segment, size) where it was copied
+        """
+        data, buffers = serialization.dumps(obj)
+        descriptors = []
+        for buffer in buffers:
+            num = None
+            if self.threshold <= buffer.nbytes <= self.segment_size:
+                num = self.take(run)
+            if num is None:
+                descriptors.append(bytes(buffer))
+                continue
+            self.segments[num].buf[: buffer.nbytes] = buffer
+            # Written, from now on the parent may recycle it
+            self.owners[num] = run
+            descriptors.append((num, buffer.nbytes))
+        return data, descriptors
+
+    def receiving(self, messages, run):
+        r"""Rebuilds the objects of a run (see :meth:`open_run`) as they arrive.
+
+        Returns:
+            iterator: the objects, the run is closed once it is collected
+        """
+        received = (self.receive(message) for message in messages)
+        finalize(received, self.close_run, run).atexit = False
+        return received
+
+    def receive(self, message):
+        r"""Rebuilds an object sent by :meth:`send` in the parent."""
+        # Segments of closed runs finished since they were closed
+        self.reclaim()
+        data, descriptors = message
+        buffers = []
+        for descriptor in descriptors:
+            if isinstance(descriptor, bytes):
+                buffers.append(bytearray(descriptor))
+                continue
+            num, size = descriptor
+            segment = self.segments[num]
+            # Arrays rebuilt from the lease (and their views) keep it alive
+            lease = np.frombuffer(segment.buf, np.uint8, size)
+            self.leased.add(segment)
+            # The lease's memoryview of the segment is finalized after it is
+            # released, the lease itself before. Not at interpreter exit, leases
+            # may still be alive then.
+            finalize(lease.base, self.release, num, segment).atexit = False
+            buffers.append(lease)
+        return serialization.loads(data, buffers)
@@ -1,7 +1,210 @@
-from inspect import getsource
+from inspect import getsource, getsourcefile
 from hashlib import sha256
+from textwrap import dedent
+from threading import Lock
+import ast
+import json
+import os
 import secrets
 import string
+import sys
+import warnings
+
+import numpy as np
+
+# Path of a JSON file caching the digests of classes between runs
+CACHE_ENV = "DAME_VERSION_CACHE"
+
+_digests = {}
+_disk_cache = None
+_disk_cache_lock = Lock()
+
+
+def strip_docstrings(tree):
+    r"""Removes the docstrings of modules, classes and functions in the tree."""
+    for node in ast.walk(tree):
+        if not isinstance(
+            node, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)
+        ):
+            continue
+        body = node.body
+        if (
+            body
+            and isinstance(body[0], ast.Expr)
+            and isinstance(constant_value(body[0].value, None), str)
+        ):
+            node.body = body[1:] or [ast.Pass()]
+    return tree
+
+
+def constant_value(node, default=None):
+    r"""The value of a constant node, ``ast.Constant`` or the older ``ast.Str``,
+    ``ast.Num``, ``ast.Bytes``, ``ast.NameConstant`` and ``ast.Ellipsis``.
+
+    Returns:
+        the default for other nodes
+    """
+    if isinstance(node, ast.Constant):
+        return node.value
+    name = type(node).__name__
+    if name in ("Str", "Bytes"):
+        return node.s
+    if name == "Num":
+        return node.n
+    if name == "NameConstant":
+        return node.value
+    if name == "Ellipsis":
+        return ...
+    return default
+
+
+def normalized_ast(node):
+    r"""A form of the AST that doesn't depend on the Python version.
+
+    Nodes are lists of their type's name and their fields, constants of every
+    version are ``Constant`` nodes, subscripts drop ``Index`` and ``ExtSlice``
+    wrappers and fields that are empty or unset (e.g. ``type_comment``,
+    ``type_params``) are left out. Positions are not fields, so they aren't part
+    of it.
+    """
+    if isinstance(node, list):
+        return [normalized_ast(item) for item in node]
+    if not isinstance(node, ast.AST):
+        return repr(node)
+    missing = object()
+    value = constant_value(node, missing)
+    if value is not missing:
+        return ["Constant", type(value).__name__, repr(value)]
+    name = type(node).__name__
+    if name == "Index":
+        return normalized_ast(node.value)
+    if name == "ExtSlice":
+        return ["Tuple", ["elts", normalized_ast(node.dims)], ["ctx", ["Load"]]]
+    fields = [
+        [field, normalized_ast(getattr(node, field))]
+        for field in node._fields
+        if getattr(node, field, None) not in (None, [])
+    ]
+    return [name, *fields]
+
+
+def source_digest(source):
+    r"""Hash of the normalized AST of the code.
+
+    Comments, docstrings and formatting don't change it, neither does the Python
+    version parsing it, see :func:`normalized_ast`.
+    """
+    tree = strip_docstrings(ast.parse(dedent(source)))
+    return sha256(json.dumps(normalized_ast(tree)).encode()).hexdigest()
+
+
+def stable_digest(value):
+    r"""Hash of a value, the same in every process and every run.
+
+    Versionables hash to their version, classes to their qualified name. None,
+    bool, int, float, complex, str, bytes, numpy arrays and scalars hash their
+    contents, so do tuples, lists, dicts, sets and frozensets of such values.
+
+    Any other value hashes to its type (and its own qualified name, e.g. of a
+    function) with a warning: its repr may change from run to run (e.g.
+    ``<Model object at 0x7f…>``), make it a Versionable to version its contents.
+    """
+    digest = sha256()
+    update_digest(digest, value)
+    return digest.hexdigest()
+
+
+def update_digest(digest, value):
+    def update(tag, *parts):
+        digest.update(tag.encode())
+        for part in parts:
+            part = part if isinstance(part, (bytes, bytearray)) else str(part).encode()
+            digest.update(len(part).to_bytes(8, "little"))
+            digest.update(part)
+
+    if hasattr(value, "__version_str__"):
+        update("V", value.__version_str__)
+    elif hasattr(value, "version"):
+        update("V", value.version())
+    elif isinstance(value, type):
+        update("C", value.__module__, value.__qualname__)
+    elif isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            update("O", value.shape)
+            for item in value.ravel().tolist():
+                update_digest(digest, item)
+        else:
+            update("A", value.dtype.str, value.shape)
+            digest.update(np.ascontiguousarray(value).data)
+    elif isinstance(value, np.generic):
+        update("G", value.dtype.str, value.tobytes())
+    elif value is None or isinstance(value, (bool, int, float, complex, str)):
+        update("S", type(value).__name__, repr(value))
+    elif isinstance(value, (bytes, bytearray)):
+        update("B", value)
+    elif isinstance(value, (tuple, list)):
+        update("L", type(value).__name__, len(value))
+        for item in value:
+            update_digest(digest, item)
+    elif isinstance(value, dict):
+        update("D", len(value))
+        for key, item in sorted((stable_digest(k), v) for k, v in value.items()):
+            update("K", key, stable_digest(item))
+    elif isinstance(value, (set, frozenset)):
+        update("E", len(value), *sorted(stable_digest(item) for item in value))
+    else:
+        warnings.warn(
+            f"{type(value).__qualname__} values are versioned by their type only, "
+            "their repr is not stable between runs. Make them Versionable."
+        )
+        name = getattr(value, "__qualname__", None)
+        update("T", type(value).__module__, type(value).__qualname__, name)
+
+
+def disk_cache_key(cls):
+    try:
+        path = getsourcefile(cls)
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    version = "{}.{}".format(*sys.version_info[:2])
+    return f"{version}:{path}:{stat.st_mtime_ns}:{stat.st_size}:{cls.__qualname__}"
+
+
+def class_digest(cls):
+    r"""Hash of the class's code, computed once per class.
+
+    If the DAME_VERSION_CACHE environment variable is set, the hashes are also
+    cached in that file, keyed by the Python version and the source file's path
+    and modification time.
+    """
+    if cls not in _digests:
+        path = os.environ.get(CACHE_ENV, None)
+        key = disk_cache_key(cls) if path else None
+        if key is None:
+            _digests[cls] = source_digest(getsource(cls))
+        else:
+            _digests[cls] = disk_cached_digest(path, key, cls)
+    return _digests[cls]
+
+
+def disk_cached_digest(path, key, cls):
+    global _disk_cache
+    with _disk_cache_lock:
+        if _disk_cache is None:
+            try:
+                with open(path) as f:
+                    _disk_cache = json.load(f)
+            except (OSError, ValueError):
+                _disk_cache = {}
+        if key not in _disk_cache:
+            _disk_cache[key] = source_digest(getsource(cls))
+            # Replaced atomically, processes writing at once lose only entries
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(_disk_cache, f)
+            os.replace(tmp_path, path)
+        return _disk_cache[key]
 
 
 class Versionable:
@@ -11,6 +214,7 @@ class Versionable:
         if getattr(self, "_versionables", None) is None:
             self._versionables = {}
         self._versionables.update(**kwargs)
+        self.__dict__.pop("_version", None)
 
     def version(self):
         """Detects changes in subclass's code and parameters.
@@ -19,16 +223,21 @@ class Versionable:
         For this to work Dame needs a way to determine whether the Transform had
         changed since the last use.
 
+        The code is hashed once per class, comments, docstrings and formatting
+        don't count, see :func:`class_digest`. The version is computed once per
+        instance, registering parameters resets it.
+
         Returns:
             str: Hash computed over source code of the class and it's parameters
         """
         if hasattr(self, "__version_str__") and self.__version_str__ is not None:
             return self.__version_str__
-        result = sha256()
-        # TODO strip docs and comments from getsource. Maybe using astunparse?
-        result.update(getsource(self.__class__).encode())
-        result.update(self.get_params_hash().encode())
-        return result.hexdigest()
+        if "_version" not in self.__dict__:
+            result = sha256()
+            result.update(class_digest(self.__class__).encode())
+            result.update(self.get_params_hash().encode())
+            self._version = result.hexdigest()
+        return self._version
 
     def get_params_hash(self):
         result = sha256()
@@ -42,8 +251,9 @@ class Versionable:
             return x.__version_str__
         elif hasattr(x, "version"):
             return x.version()
-        # TODO issue a warning for objects (str(x) == "<some_class object at 0x838>")
-        return str(x)
+        elif x is None or isinstance(x, (bool, int, float, str)):
+            return str(x)
+        return stable_digest(x)
 
 
 class Unversionable(Versionable):
@@ -1,47 +1,145 @@
-from multiprocessing import Pool
+import os
+from collections import ChainMap
+from contextlib import contextmanager
+from functools import partial
+from itertools import chain, islice, product, repeat
+from multiprocessing import Pool, Process, Queue
+from multiprocessing.pool import ThreadPool
 from multiprocessing.util import Finalize
+from queue import Empty, Queue as ThreadQueue
+from threading import Barrier, Thread, local
+from time import perf_counter
+from weakref import WeakKeyDictionary
 
+from . import serialization
+from .reducer import TreeCombiner
 from .stages import Stages
 from .source import SourceWrap
+from .transport import SharedMemoryTransport
+
+
+def batched(iterable, size):
+    r"""Groups the items of an iterable into lists of (at most) size items."""
+    it = iter(iterable)
+    batch = list(islice(it, size))
+    while batch:
+        yield batch
+        batch = list(islice(it, size))
+
+
+def run_store_writer(store_cls, kwargs, queue):
+    r"""Writes the results other stores send through the queue, see ``serve``."""
+    store = store_cls((), **kwargs)
+    store.open()
+    try:
+        store.serve(queue)
+    finally:
+        store.close()
 
 
 def make_stage_with_context(stage_cls, context):
+    r"""Creates a transform with its arguments from the context.
+
+    The arguments are registered as versionable parameters, so that results of
+    different arguments are stored separately.
+    """
     if stage_cls.__name__ in context:
         ctx = context[stage_cls.__name__]
-        return stage_cls(*ctx.get("args", []), **ctx.get("kwargs", {}))
+        stage = stage_cls(*ctx.get("args", []), **ctx.get("kwargs", {}))
+        if hasattr(stage, "register_params"):
+            stage.register_params(__context__=ctx)
+        return stage
     return stage_cls()
 
 
 class SequentialWorker:
-    r"""Performs all the necessary computations in a current process"""
+    r"""Performs all the necessary computations in a current process
+
+    Pools keep one instance per worker process (or thread), see :meth:`current`.
+
+    Computations of given keys drop every other key right after its last consumer
+    runs, see :meth:`Stages.releases`. So do full computations if keep is given,
+    only the keys to keep (and the index) are left in the results.
+
+    Constants (results of the reducers) are passed to the transforms requiring
+    them, they are not added to the computed elements.
+    """
+
+    _local = local()
 
     @staticmethod
-    def make_instance(stages, context, store):
-        SequentialWorker.instance = SequentialWorker(
-            stages, context, global_store=store
-        )
-        SequentialWorker.instance.__enter__()
-        # https://stackoverflow.com/a/24724452
-        Finalize(
-            SequentialWorker.instance,
-            SequentialWorker.instance.__exit__,
-            args=(None, None, None),
-            exitpriority=10,
+    def make_instance(
+        stages,
+        context,
+        store,
+        finalize=True,
+        store_options=None,
+        transport=None,
+        cache=None,
+        keep=None,
+        constants=None,
+        cache_reports=None,
+    ):
+        instance = SequentialWorker(
+            stages,
+            context,
+            global_store=store,
+            store_options=store_options,
+            cache=cache,
+            keep=keep,
+            constants=constants,
         )
+        instance.transport = transport
+        instance.cache_reports = cache_reports
+        instance.__enter__()
+        SequentialWorker._local.instance = instance
+        if finalize:
+            # https://stackoverflow.com/a/24724452
+            Finalize(
+                instance, instance.__exit__, args=(None, None, None), exitpriority=10,
+            )
+
+    @staticmethod
+    def current():
+        r"""The instance made for the current worker process or thread."""
+        return SequentialWorker._local.instance
+
+    @staticmethod
+    def release_instance(barrier):
+        # Every thread of a pool waits, so each one releases exactly its instance
+        barrier.wait()
+        SequentialWorker._local.instance.__exit__(None, None, None)
+        del SequentialWorker._local.instance
+
+    @staticmethod
+    def store_kwargs(context, global_store, store_options=None):
+        r"""Arguments of the store from the context, updated with store_options."""
+        kwargs = {"db_args": [], "db_kwargs": {}}
+        kwargs.update(context.get(global_store.__name__, {}))
+        kwargs.update(store_options or {})
+        if kwargs.get("db_cls", None) is None:
+            kwargs.pop("db_cls", None)
+        return kwargs
 
-    def __init__(self, stages, context, global_store=None):
+    def __init__(
+        self,
+        stages,
+        context,
+        global_store=None,
+        store_options=None,
+        cache=None,
+        keep=None,
+        constants=None,
+    ):
         self.stages = stages
         self.context = context
+        self.cache = cache
+        self.keep = tuple(keep) if keep is not None else None
+        self.constants = constants or {}
+        self.versions = WeakKeyDictionary()
         if global_store is not None:
-            ctx = context.get(global_store.__name__, {})
-            kwargs = {
-                "db_args": ctx.get("db_args", []),
-                "db_kwargs": ctx.get("db_kwargs", {}),
-            }
-            db_cls = ctx.get("db_cls", None)
-            if db_cls is not None:
-                kwargs["db_cls"] = db_cls
-            self.store = global_store(self.stages, **kwargs)
+            kwargs = self.store_kwargs(context, global_store, store_options)
+            self.store = global_store((), **kwargs)
 
     def __enter__(self):
         if hasattr(self, "store"):
@@ -51,19 +149,215 @@ class SequentialWorker:
     def __exit__(self, exc_type, exc_value, traceback):
         if hasattr(self, "store"):
             self.store.close()
+        reports = getattr(self, "cache_reports", None)
+        if reports is not None and self.cache is not None:
+            # The copy of the cache in a process pool's worker
+            reports.put(self.cache.stats())
+            self.cache_reports = None
 
     @property
     def stage_instances(self):
-        if not hasattr(self, "_stage_instances"):
-            self._stage_instances = [
-                make_stage_with_context(stage_cls, self.context)
-                for stage_cls in self.stages
+        return [self.stage_instance(stage_cls) for stage_cls in self.stages]
+
+    def stage_instance(self, stage_cls, context=None):
+        r"""The instance of a transform in a context, created on first use.
+
+        The providers of its arguments (instances in the same context, defaults to
+        the worker's) are registered as its versionable parameters. So its version,
+        the key of its stored results, is a hash over the versions of all the
+        transforms it depends on and changes with any of them.
+        """
+        context = self.context if context is None else context
+        upstream = {
+            kw: self.stage_instance(provider, context)
+            if isinstance(provider, type)
+            else provider
+            for kw, provider in self.stages.upstream(stage_cls).items()
+        }
+        key = (
+            stage_cls,
+            self.argument_key(context, stage_cls),
+            tuple(id(provider) for provider in upstream.values()),
+        )
+        instances = self.__dict__.setdefault("_stage_instances", {})
+        if key not in instances:
+            stage = make_stage_with_context(stage_cls, context)
+            if hasattr(stage, "register_params"):
+                stage.register_params(
+                    **{
+                        f"__input_{kw}__": provider
+                        for kw, provider in upstream.items()
+                        if hasattr(provider, "version")
+                    }
+                )
+            instances[key] = stage
+        return instances[key]
+
+    def argument_key(self, context, stage_cls):
+        r"""The key of a transform's arguments in a context: the identity of the
+        arguments object, which stays referenced so that it is not reused.
+
+        Nothing is hashed here, the arguments are versioned only when a version is
+        needed (e.g. to store the results), see :func:`dame.versionable.stable_digest`.
+        """
+        variant = context.get(stage_cls.__name__, None)
+        variants = self.__dict__.setdefault("_argument_variants", {})
+        variants.setdefault(id(variant), variant)
+        return id(variant)
+
+    def compiled_plan(self, *keywords):
+        r"""The plan from :meth:`Stages.plan` bound to this worker's instances.
+
+        Returns:
+            list(tuple(Transform, tuple(str), tuple(str))): stages with the names
+                of their arguments and of the keys they provide
+        """
+        plans = self.__dict__.setdefault("_compiled_plans", {})
+        key = frozenset(keywords)
+        if key not in plans:
+            plans[key] = [
+                (self.stage_instance(step.transform), step.requires, step.provides)
+                for step in self.stages.plan(*keywords)
             ]
-        return self._stage_instances
+        return plans[key]
+
+    def needed_stages(self, plan, keys, idx, snapshot, cached):
+        r"""Plans backwards from the keys which stages to load or compute for idx.
+
+        A stage whose results are stored (or cached) is loaded and its own inputs
+        are not needed, so upstream stages are visited only for the stages to
+        compute. Results found in the cache are kept in cached until loaded, so
+        that an eviction can't invalidate the plan.
+
+        Returns:
+            set(Transform)|None: the needed stages, None when all are needed
+        """
+        if keys is None or (snapshot is None and self.cache is None):
+            return None
+        needed_keys, needed = set(keys), set()
+        for stage, requires, provides in reversed(plan):
+            if needed_keys.isdisjoint(provides):
+                continue
+            needed.add(stage)
+            needed_keys.difference_update(provides)
+            if not self.is_stored(idx, stage, snapshot, cached):
+                needed_keys.update(requires)
+        return needed
+
+    def is_stored(self, idx, stage, snapshot, cached):
+        if (idx, stage) not in cached:
+            cached[idx, stage] = self.load_from_cache(idx, stage)
+        if cached[idx, stage] is not None:
+            return True
+        return snapshot is not None and (idx, stage) in snapshot
+
+    def run_plan(self, data, plan, keys=None, releases=None):
+        r"""Computes (or loads from the store) the stages of a compiled plan.
+
+        Args:
+            data (dict): data from source or previous transforms
+            plan (list): see :meth:`compiled_plan`
+            keys (tuple(str), optional): keys needed after the plan. When given, the
+                stages whose outputs are covered by stored results are skipped.
+            releases (tuple(tuple(str)), optional): keys to drop after every stage,
+                see :meth:`Stages.releases`
+
+        Returns:
+            dict: updated data
+        """
+        idx = data["idx"]
+        snapshot, cached = self.snapshot([idx], plan, keys), {}
+        needed = self.needed_stages(plan, keys, idx, snapshot, cached)
+        if needed is not None and snapshot is not None:
+            snapshot.fetch((idx, s) for s in needed if cached[idx, s] is None)
+        for (stage, requires, _), dead in zip(plan, releases or repeat(())):
+            if needed is None or stage in needed:
+                new_data = self.load_from_store(idx, stage, snapshot, cached)
+                if new_data is None:
+                    new_data = stage.apply(**self.arguments(requires, data))
+                    self.save_to_store(idx, stage, new_data)
+                data.update(new_data)
+                del new_data
+            for key in dead:
+                data.pop(key, None)
+        return data
+
+    def run_plan_batch(self, items, plan, keys=None, releases=None):
+        r"""Computes the stages of a compiled plan for a batch of items.
+
+        Every stage processes the whole batch before the next one starts. Stages
+        with ``apply_batch`` get lists of values for their arguments, the rest
+        fall back to ``apply`` per item. Store is accessed once per stage.
+
+        Args:
+            items (list(dict)): data from source or previous transforms
+            plan (list): see :meth:`compiled_plan`
+            keys (tuple(str), optional): see :meth:`run_plan`
+            releases (tuple(tuple(str)), optional): see :meth:`run_plan`
+
+        Returns:
+            list(dict): updated items
+        """
+        idxs = [data["idx"] for data in items]
+        snapshot, cached = self.snapshot(idxs, plan, keys), {}
+        needed = [self.needed_stages(plan, keys, idx, snapshot, cached) for idx in idxs]
+        if keys is not None and snapshot is not None:
+            snapshot.fetch(
+                (idx, stage)
+                for idx, stages in zip(idxs, needed)
+                for stage in stages
+                if cached[idx, stage] is None
+            )
+        for (stage, requires, _), dead in zip(plan, releases or repeat(())):
+            self.run_stage_batch(
+                items, idxs, stage, requires, needed, snapshot, cached
+            )
+            for key in dead:
+                for data in items:
+                    data.pop(key, None)
+        return items
+
+    def run_stage_batch(self, items, idxs, stage, requires, needed, snapshot, cached):
+        r"""Loads or computes a stage of :meth:`run_plan_batch` for the items."""
+        batch = [i for i, n in enumerate(needed) if n is None or stage in n]
+        if not batch:
+            return
+        loaded = self.load_many_from_store(
+            [idxs[i] for i in batch], stage, snapshot, cached
+        )
+        missing = [j for j, new_data in enumerate(loaded) if new_data is None]
+        if missing:
+            computed = self.apply_batch(
+                stage, requires, [items[batch[j]] for j in missing]
+            )
+            for j, new_data in zip(missing, computed):
+                loaded[j] = new_data
+            self.save_many_to_store([idxs[batch[j]] for j in missing], stage, computed)
+        for i, new_data in zip(batch, loaded):
+            items[i].update(new_data)
+
+    def arguments(self, requires, data):
+        r"""Values of the keys from the constants or from data."""
+        return {
+            key: self.constants[key] if key in self.constants else data[key]
+            for key in requires
+        }
+
+    def apply_batch(self, stage, requires, items):
+        if not hasattr(stage, "apply_batch"):
+            return [stage.apply(**self.arguments(requires, data)) for data in items]
+        columns = [self.arguments(requires, data) for data in items]
+        results = stage.apply_batch(
+            **{key: [args[key] for args in columns] for key in requires}
+        )
+        assert len(results) == len(items), (
+            f"{stage.__class__.__name__}.apply_batch must return a result per item"
+        )
+        return results
 
     @staticmethod
     def instance_compute_to(d, kw):
-        return SequentialWorker.instance.compute_to(d, kw)
+        return SequentialWorker.current().compute_to(d, kw)
 
     def compute_to(self, data, keyword):
         r"""Computes an element upto the transform T that provides the keyword (including T).
@@ -75,19 +369,13 @@ class SequentialWorker:
         Returns:
             dict: data after transformation via all declared transforms
         """
-        cls_it = self.stages.to(keyword)
-        stage_it = iter(self.stage_instances)
-        while keyword not in data:
-            stage = next(stage_it)
-            next_cls = next(cls_it)
-            while not isinstance(stage, next_cls):
-                stage = next(stage_it)
-            data = self.compute_stage(data, stage)
-        return data
+        if keyword in data:
+            return data
+        return self.run_plan(data, self.compiled_plan(keyword), (keyword,))
 
     @staticmethod
     def instance_compute_full(d):
-        return SequentialWorker.instance.compute_full(d)
+        return SequentialWorker.current().compute_full(d)
 
     def compute_full(self, data):
         r"""Computes an element using all the transforms
@@ -96,26 +384,270 @@ class SequentialWorker:
             data (dict): data from source
         
         Returns:
-            dict: data after transformation via all declared transforms
+            dict: data after transformation via all declared transforms, only the
+                keys to keep if given
         """
-        for stage in self.stage_instances:
-            data = self.compute_stage(data, stage)
-        return data
+        data = self.run_plan(data, self.compiled_plan(), releases=self.releases())
+        if self.keep is None:
+            return data
+        return {key: data[key] for key in self.keep + ("idx",)}
+
+    def releases(self, keys=None):
+        r"""Keys to drop after every stage of the plan for keys, see :meth:`run_plan`.
+
+        Args:
+            keys (tuple(str), optional): keywords to compute. Defaults to None (all).
+        """
+        if keys is not None:
+            return self.stages.releases(keys, *keys)
+        if self.keep is not None:
+            return self.stages.releases(self.keep)
+        return None
+
+    @staticmethod
+    def instance_compute_keys(keys, d):
+        return SequentialWorker.current().compute_keys(d, keys)
+
+    def compute_keys(self, data, keys):
+        r"""Computes only the transforms needed for the keys.
+
+        Args:
+            data (dict): data from source
+            keys (tuple(str)): keywords to compute
+
+        Returns:
+            dict: `{key: computed_value for key in keys}`
+        """
+        data = self.run_plan(data, self.compiled_plan(*keys), keys, self.releases(keys))
+        return self.arguments(keys, data)
+
+    @staticmethod
+    def instance_compute_batch(keys, items):
+        return SequentialWorker.current().compute_batch(items, keys)
+
+    def compute_batch(self, items, keys=None):
+        r"""Computes a batch of elements stage by stage.
+
+        Args:
+            items (list(dict)): data from source
+            keys (tuple(str), optional): keywords to compute. Defaults to None (all).
+
+        Returns:
+            list(dict): computed elements, only the keys (or the keys to keep) if given
+        """
+        plan = self.compiled_plan(*(keys or ()))
+        items = self.run_plan_batch(items, plan, keys, self.releases(keys))
+        if keys is None and self.keep is None:
+            return items
+        keys = keys or self.keep + ("idx",)
+        return [self.arguments(keys, data) for data in items]
+
+    @staticmethod
+    def instance_compute_columns(keys, items):
+        return SequentialWorker.current().compute_columns(items, keys)
+
+    def compute_columns(self, items, keys=None):
+        r"""Computes a chunk of elements stage by stage, see :meth:`compute_batch`.
+
+        Args:
+            items (list(dict)): data from source
+            keys (tuple(str), optional): keywords to compute. Defaults to None (all).
+
+        Returns:
+            dict: `{key: [value of every element]}`
+        """
+        items = self.compute_batch(items, keys)
+        return {key: [data[key] for data in items] for key in items[0]}
+
+    @staticmethod
+    def instance_compute_reducing(keys, items):
+        return SequentialWorker.current().compute_reducing(items, keys)
+
+    def compute_reducing(self, items, keys=None):
+        r"""Computes a batch of elements and folds them into partial accumulators.
+
+        Args:
+            items (list(dict)): data from source
+            keys (tuple(str), optional): see :meth:`compute_batch`
+
+        Returns:
+            tuple(list(dict), list): computed elements (see :meth:`compute_batch`)
+                and an accumulator for every reducer, see :class:`dame.reducer.Reducer`
+        """
+        reducers = [self.stage_instance(cls) for cls in self.stages.reducers]
+        requires = [self.stages.get_requirements(reducer) for reducer in reducers]
+        outputs = keys
+        if keys is None and self.keep is not None:
+            outputs = self.keep + ("idx",)
+        if outputs is None:
+            items = self.compute_batch(items)
+        else:
+            needed = set(chain.from_iterable(requires)).union(outputs)
+            items = self.compute_batch(items, tuple(needed))
+        accumulators = []
+        for reducer, names in zip(reducers, requires):
+            accumulator = reducer.start()
+            for data in items:
+                accumulator = reducer.update(
+                    accumulator, **{key: data[key] for key in names}
+                )
+            accumulators.append(accumulator)
+        if outputs is not None:
+            items = [self.arguments(outputs, data) for data in items]
+        return items, accumulators
+
+    @staticmethod
+    def instance_compute_sweep(sweep, contexts, keys, d):
+        worker = SequentialWorker.current()
+        # A process pool sends a copy with every task, the first one is kept so that
+        # the instances of the configurations are reused, see argument_key
+        contexts = worker.__dict__.setdefault("_sweeps", {}).setdefault(sweep, contexts)
+        return worker.compute_sweep(d, contexts, keys)
+
+    def compute_sweep(self, data, contexts, keys=None):
+        r"""Computes an element for several configurations at once.
+
+        A stage's result is computed once for all the configurations sharing its
+        arguments and the arguments of all its upstream stages, see
+        :meth:`stage_instance`.
+
+        Args:
+            data (dict): data from source
+            contexts (list(dict)): context of every configuration
+            keys (tuple(str), optional): keywords to compute. Defaults to None (all).
+
+        Returns:
+            list(dict): the element computed in every configuration
+        """
+        outputs = keys
+        if keys is None and self.keep is not None:
+            outputs = self.keep + ("idx",)
+        idx, memo, results = data["idx"], {}, []
+        for context in contexts:
+            item = dict(data)
+            for stage, requires in self.sweep_plan(context, keys):
+                if stage not in memo:
+                    new_data = self.load_from_store(idx, stage)
+                    if new_data is None:
+                        new_data = stage.apply(**self.arguments(requires, item))
+                        self.save_to_store(idx, stage, new_data)
+                    memo[stage] = new_data
+                item.update(memo[stage])
+            results.append(item if outputs is None else self.arguments(outputs, item))
+        return results
+
+    def sweep_plan(self, context, keys=None):
+        r"""The plan for keys bound to the instances of a configuration's context.
+
+        Returns:
+            list(tuple(Transform, tuple(str))): stages with the names of their
+                arguments
+        """
+        plans = self.__dict__.setdefault("_sweep_plans", {})
+        key = (
+            tuple(self.argument_key(context, stage) for stage in self.stages),
+            frozenset(keys or ()),
+        )
+        if key not in plans:
+            plans[key] = [
+                (self.stage_instance(step.transform, context), step.requires)
+                for step in self.stages.plan(*(keys or ()))
+            ]
+        return plans[key]
+
+    @staticmethod
+    def instance_framed(func, d):
+        return serialization.frame(func(d))
+
+    @staticmethod
+    def instance_transported(func, run, d):
+        return SequentialWorker.current().transport.send(func(d), run)
+
+    @staticmethod
+    def instance_timed(func, d):
+        start = perf_counter()
+        data = func(d)
+        return data, perf_counter() - start
+
+    @staticmethod
+    def instance_indexed(func, items):
+        return [(idx, func(d)) for idx, d in items]
 
     @staticmethod
     def instance_compute_stage(d, s):
-        return SequentialWorker.instance.compute_stage(d, s)
+        return SequentialWorker.current().compute_stage(d, s)
 
-    def load_from_store(self, idx, transform):
-        if not hasattr(self, "store"):
+    def snapshot(self, idxs, plan, keys=None):
+        r"""Prefetches stored results of the plan's stages, if the store can.
+
+        With keys given only the presence of results is fetched, their blobs are
+        fetched after planning the needed stages, see :meth:`needed_stages`.
+        """
+        if not hasattr(self, "store") or not hasattr(self.store, "snapshot"):
             return None
-        return self.store.load(idx, transform)
+        stages = [stage for stage, _, _ in plan]
+        return self.store.snapshot(idxs, stages, blobs=keys is None)
+
+    def cache_key(self, idx, transform):
+        if transform not in self.versions:
+            self.versions[transform] = transform.version()
+        return self.versions[transform], idx
+
+    def load_from_cache(self, idx, transform, cached=None):
+        r"""Looks a result up in the results kept by planning, then in the cache."""
+        if cached is not None and (idx, transform) in cached:
+            return cached.pop((idx, transform))
+        if self.cache is None:
+            return None
+        return self.cache.get(self.cache_key(idx, transform))
+
+    def save_to_cache(self, idx, transform, data):
+        if self.cache is not None and data is not None:
+            self.cache.put(self.cache_key(idx, transform), data)
+
+    def load_from_store(self, idx, transform, snapshot=None, cached=None):
+        data = self.load_from_cache(idx, transform, cached)
+        if data is not None:
+            return data
+        if snapshot is not None:
+            data = snapshot.load(idx, transform)
+        elif hasattr(self, "store"):
+            data = self.store.load(idx, transform)
+        self.save_to_cache(idx, transform, data)
+        return data
 
     def save_to_store(self, idx, transform, data):
+        self.save_to_cache(idx, transform, data)
         if not hasattr(self, "store"):
             return
         self.store.save(idx, transform, data)
 
+    def load_many_from_store(self, idxs, transform, snapshot=None, cached=None):
+        loaded = [self.load_from_cache(idx, transform, cached) for idx in idxs]
+        missing = [i for i, data in enumerate(loaded) if data is None]
+        if not missing or (snapshot is None and not hasattr(self, "store")):
+            return loaded
+        if snapshot is not None:
+            datas = [snapshot.load(idxs[i], transform) for i in missing]
+        elif hasattr(self.store, "load_many"):
+            datas = self.store.load_many([idxs[i] for i in missing], transform)
+        else:
+            datas = [self.store.load(idxs[i], transform) for i in missing]
+        for i, data in zip(missing, datas):
+            loaded[i] = data
+            self.save_to_cache(idxs[i], transform, data)
+        return loaded
+
+    def save_many_to_store(self, idxs, transform, datas):
+        for idx, data in zip(idxs, datas):
+            self.save_to_cache(idx, transform, data)
+        if not hasattr(self, "store"):
+            return
+        if hasattr(self.store, "save_many"):
+            return self.store.save_many(idxs, transform, datas)
+        for idx, data in zip(idxs, datas):
+            self.store.save(idx, transform, data)
+
     def compute_stage(self, data, stage):
         r"""Computes a single stage
         
@@ -126,65 +658,656 @@ class SequentialWorker:
         Returns:
             dict: updated data
         """
-        new_data = self.load_from_store(data["idx"], stage)
-        if new_data is not None:
-            data.update(new_data)
-            return data
+        plan = [(stage, self.stages.get_requirements(stage), tuple(stage.provides))]
+        return self.run_plan(data, plan)
 
-        kwargs = {
-            key: value
-            for key, value in data.items()
-            if key in self.stages.get_requirements(stage)
-        }
-        new_data = stage.apply(**kwargs)
-        data.update(new_data)
-        self.save_to_store(data["idx"], stage, new_data)
-        return data
 
+class SequentialResult:
+    r"""A result of :meth:`SequentialPool.apply_async`, computed already."""
 
-class PoolJoiningIterator:
-    def __init__(self, base_iter, pool):
-        self.it = base_iter
-        self.pool = pool
+    def __init__(self, value=None, error=None):
+        self.value, self.error = value, error
 
-    def __iter__(self):
+    def get(self, timeout=None):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class SequentialPool:
+    r"""A pool-like executor computing everything in the calling thread."""
+
+    def __init__(self, initializer, initargs=()):
+        with self.bound():
+            initializer(*initargs)
+            self.worker = SequentialWorker.current()
+
+    @contextmanager
+    def bound(self):
+        r"""Makes this pool's worker current for the duration of a with block."""
+        previous = getattr(SequentialWorker._local, "instance", None)
+        if hasattr(self, "worker"):
+            SequentialWorker._local.instance = self.worker
         try:
-            yield from self.it
+            yield
         finally:
-            self.pool.close()
-            self.pool.join()
+            SequentialWorker._local.instance = previous
+
+    def call(self, func, item):
+        with self.bound():
+            return func(item)
+
+    def imap(self, func, iterable, chunksize=1):
+        return (self.call(func, item) for item in iterable)
+
+    imap_unordered = imap
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        try:
+            with self.bound():
+                result = SequentialResult(func(*args))
+        except Exception as error:
+            result = SequentialResult(error=error)
+            if error_callback is not None:
+                error_callback(error)
+        else:
+            if callback is not None:
+                callback(result.value)
+        return result
+
+    def map(self, func, iterable, chunksize=None):
+        return list(self.imap(func, iterable))
+
+    def close(self):
+        self.worker.__exit__(None, None, None)
+
+    terminate = close
+
+    def join(self):
+        pass
+
+
+class ReorderingIterator:
+    r"""Yields the results of chunks completing out of order in the order of items.
+
+    Chunks are submitted with ``pool.apply_async`` as long as at most ``size``
+    items are in flight or wait in a buffer keyed by their index. The bound is kept
+    here, in the consumer, nothing waits in the pool's threads, so other
+    computations share the pool and an abandoned iteration blocks nothing.
+    """
+
+    def __init__(self, pool, func, items, chunksize, size, start=0):
+        self.pool, self.func, self.items = pool, func, items
+        # A single chunk must fit in the buffer
+        self.chunksize, self.size = chunksize, max(size, chunksize)
+        self.start = start
+
+    def submit(self, chunk, done):
+        r"""Computes a chunk in the pool, its first index is put to done after."""
+        key = chunk[0][0]
+        return self.pool.apply_async(
+            partial(SequentialWorker.instance_indexed, self.func),
+            (chunk,),
+            callback=lambda _: done.put(key),
+            error_callback=lambda _: done.put(key),
+        )
+
+    def __iter__(self):
+        chunks = batched(enumerate(self.items, self.start), self.chunksize)
+        done, pending, buffer = ThreadQueue(), {}, {}
+        in_flight, next_idx = 0, self.start
+        while True:
+            while in_flight + self.chunksize <= self.size:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending[chunk[0][0]] = self.submit(chunk, done)
+                in_flight += len(chunk)
+            if not pending:
+                return
+            # Raises the error of a failed chunk
+            buffer.update(pending.pop(done.get()).get())
+            while next_idx in buffer:
+                in_flight -= 1
+                yield buffer.pop(next_idx)
+                next_idx += 1
 
 
 class WorkManager:
-    """Manages the spawning of workers in separate processes."""
+    """Manages the spawning of workers in separate processes.
 
-    def __init__(self, source, transforms, context, n_processes=None, store=None):
+    The pool of workers is started lazily and reused by every computation until
+    :meth:`close` (or :meth:`restart`) is called. So is the worker computing single
+    elements in the calling process, see :meth:`compute_one`. WorkManager is a
+    context manager.
+
+    Args:
+        chunksize (int|"auto"): Number of items sent to a worker at once. "auto"
+            measures the per-item latency on the first items and picks a chunk size
+            that takes about ``chunk_seconds`` to compute.
+        ordering (str): "strict" - results in order, "reorder" - items complete out
+            of order and are reordered in a buffer of at most ``reorder_buffer``
+            items, "completion" - results in the order of completion.
+        reorder_buffer (int): Bound on items in flight for "reorder" ordering.
+        batch_size (int): Number of items computed together stage by stage, see
+            :meth:`SequentialWorker.compute_batch`. Chunks and the reorder buffer
+            count batches when batch_size > 1.
+        executor (str): "process" - a pool of n_processes processes, "thread" - a
+            pool of threads (for I/O bound transforms or ones releasing the GIL),
+            "sequential" - everything in the calling thread.
+        single_writer (bool): Workers send the results to store through a queue to
+            a single writer process (or thread) instead of writing them themselves.
+            The database runs in WAL mode so that workers read concurrently, their
+            connections are read-only, see :meth:`register_versions`.
+        transport (str|SharedMemoryTransport): How process workers send back the
+            results. "pickle" - as multiprocessing does, "pickle5" - pickled with
+            protocol 5, the arrays at any depth sent out-of-band in one frame and
+            rebuilt as its read-only views, copied no more than by "pickle", "shm"
+            - large arrays are sent through shared memory, see
+            :class:`dame.transport.SharedMemoryTransport`.
+        cache (MemoryCache, optional): In-memory cache of results in front of
+            the store, see :class:`dame.cache.MemoryCache`.
+        keep (tuple(str), optional): Keys left in the elements of full computations,
+            every other key is dropped right after its last consumer runs, see
+            :class:`SequentialWorker`. Defaults to None (all keys).
+        reducers (tuple(Reducer_cls)): Reducers computed in the first full pass
+            over the dataset (or loaded from the store), see :meth:`reduce`.
+    """
+
+    orderings = ("strict", "reorder", "completion")
+    executors = ("process", "thread", "sequential")
+    transports = ("pickle", "pickle5", "shm")
+    chunk_seconds = 0.05
+
+    def __init__(
+        self,
+        source,
+        transforms,
+        context,
+        n_processes=None,
+        store=None,
+        chunksize=1,
+        ordering="strict",
+        reorder_buffer=256,
+        batch_size=1,
+        executor="process",
+        single_writer=False,
+        transport="pickle",
+        cache=None,
+        keep=None,
+        reducers=(),
+    ):
+        assert ordering in self.orderings, f"Ordering must be one of {self.orderings}"
+        assert executor in self.executors, f"Executor must be one of {self.executors}"
+        if transport == "shm":
+            transport = SharedMemoryTransport()
+        assert isinstance(transport, SharedMemoryTransport) or (
+            transport in self.transports
+        ), f"Transport must be in {self.transports}"
+        assert chunksize == "auto" or chunksize >= 1, "Wrong chunksize"
         self.n_processes = n_processes
         self.source_instance = source
         self.context = context
-        self.stages = Stages(source, transforms)
+        self.stages = Stages(source, transforms, reducers)
         self.store = store
+        self.chunksize = chunksize
+        self.ordering = ordering
+        self.reorder_buffer = reorder_buffer
+        self.batch_size = batch_size
+        self.executor = executor
+        self.single_writer = single_writer
+        self.transport = transport
+        self.cache = cache
+        self.keep = keep
+        self.reducers = tuple(reducers)
+        self._reductions = None
+        self._pool = None
+        self._pool_pid = None
+        self._writer = None
+        self.writer_options = None
+        self._cache_reports = None
+        self._registrar, self._registered = None, set()
+        self._sweeps = 0
+        self._worker = None
+        self._worker_pid = None
 
     @property
     def wrapped_source_instance(self):
         if not hasattr(self, "_wrapped_source_instance"):
-            self._wrapped_source_instance = SourceWrap(self.source_instance)
+            self._wrapped_source_instance = SourceWrap(
+                self.source_instance, **self.context.get(SourceWrap.__name__, {})
+            )
         return self._wrapped_source_instance
 
-    def fast_compute(self):
-        pool = Pool(
-            processes=self.n_processes,
-            initializer=SequentialWorker.make_instance,
-            initargs=(self.stages, self.context, self.store),
+    @property
+    def pool(self):
+        r"""The pool of workers, started on first use.
+
+        A pool inherited from a parent process (after a fork) is never reused.
+        """
+        if self._pool is not None and self._pool_pid != os.getpid():
+            self._pool = None
+        if self._pool is None:
+            if self.single_writer and self.store is not None:
+                self.start_writer()
+            initargs = (self.stages, self.context, self.store)
+            transport = self.transport if self.executor == "process" else None
+            options = (
+                self.writer_options,
+                transport,
+                self.cache,
+                self.keep,
+                self._reductions,
+            )
+            if self.executor == "process":
+                if self.shared_memory:
+                    self.transport.start()
+                if self.cache is not None:
+                    self._cache_reports = Queue()
+                self._pool = Pool(
+                    self.n_workers,
+                    SequentialWorker.make_instance,
+                    initargs + (True,) + options + (self._cache_reports,),
+                )
+            elif self.executor == "thread":
+                self._pool = ThreadPool(
+                    self.n_workers,
+                    SequentialWorker.make_instance,
+                    initargs + (False,) + options,
+                )
+            else:
+                self._pool = SequentialPool(
+                    SequentialWorker.make_instance, initargs + (False,) + options,
+                )
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    @property
+    def worker(self):
+        r"""The worker of :meth:`compute_one`, made on first use.
+
+        It keeps its stage instances and store open between calls. A worker
+        inherited from a parent process (after a fork) is never reused.
+        """
+        if self._worker is not None and self._worker_pid != os.getpid():
+            self._worker = None
+        if self._worker is None:
+            self._worker = SequentialWorker(
+                self.stages,
+                self.context,
+                global_store=self.store,
+                store_options=self.writer_options,
+                cache=self.cache,
+                keep=self.keep,
+                constants=self._reductions,
+            ).__enter__()
+            self._worker_pid = os.getpid()
+        return self._worker
+
+    def start_writer(self):
+        r"""Starts the process (or thread) that writes results of all the workers.
+
+        The workers' stores only read, the tables and the versions of the transforms
+        are made before, see :meth:`register_versions`.
+        """
+        kwargs = SequentialWorker.store_kwargs(self.context, self.store, {"wal": True})
+        if self.executor == "process":
+            queue = Queue()
+            self._writer = Process(
+                target=run_store_writer, args=(self.store, kwargs, queue), daemon=True
+            )
+        else:
+            queue = ThreadQueue()
+            self._writer = Thread(
+                target=run_store_writer, args=(self.store, kwargs, queue), daemon=True
+            )
+        self._writer.start()
+        self.writer_options = {"wal": True, "writer_queue": queue}
+
+    def register_versions(self, contexts, keys=None):
+        r"""Registers the versions of the transforms computing keys, and of the
+        reducers, in the store of a single writer.
+
+        The stores sending their results to the writer only read, so the versions
+        they save are registered here, in the calling process, before computations
+        (and the tables are made). Nothing is done without a single writer.
+
+        Args:
+            contexts (list(dict)): contexts whose versions to register
+            keys (tuple(str), optional): Defaults to None (all the transforms).
+        """
+        if not self.single_writer or self.store is None:
+            return
+        if self._registrar is None:
+            self._registrar = SequentialWorker(self.stages, {})
+        worker = self._registrar
+        instances = [
+            worker.stage_instance(step.transform, context)
+            for context in contexts
+            for step in self.stages.plan(*(keys or ()))
+        ]
+        instances += [worker.stage_instance(cls, self.context) for cls in self.reducers]
+        versions = {(type(t).__name__, t.version()): t for t in instances}
+        if versions.keys() <= self._registered:
+            return
+        kwargs = SequentialWorker.store_kwargs(self.context, self.store, {"wal": True})
+        store = self.store((), **kwargs)
+        store.open()
+        try:
+            for transform in versions.values():
+                store.transform_id(transform)
+        finally:
+            store.close()
+        self._registered.update(versions)
+
+    @property
+    def shared_memory(self):
+        return self.executor == "process" and isinstance(
+            self.transport, SharedMemoryTransport
         )
 
-        res_it = pool.imap(
-            SequentialWorker.instance_compute_full,
-            (data for data in self.wrapped_source_instance),
+    @property
+    def n_workers(self):
+        if self.executor == "sequential":
+            return 1
+        return self.n_processes or os.cpu_count() or 1
+
+    def close(self):
+        r"""Stops the workers and waits for them to release their resources."""
+        if self._worker is not None and self._worker_pid == os.getpid():
+            self._worker.__exit__(None, None, None)
+        self._worker = None
+        if hasattr(self, "_wrapped_source_instance"):
+            self._wrapped_source_instance.close()
+        if self._pool is not None and self._pool_pid == os.getpid():
+            if self.executor == "thread":
+                barrier = Barrier(self.n_workers)
+                self._pool.map(
+                    SequentialWorker.release_instance, [barrier] * self.n_workers, 1
+                )
+            self._pool.close()
+            self._pool.join()
+            self.collect_cache_reports()
+            if self.shared_memory:
+                self.transport.close()
+            if self._writer is not None:
+                self.writer_options["writer_queue"].put(None)
+                self._writer.join()
+        self._pool = None
+        self._writer, self.writer_options = None, None
+
+    def collect_cache_reports(self):
+        r"""Adds the counters of the workers' caches to the cache, once they exit."""
+        while self._cache_reports is not None:
+            try:
+                self.cache.add_counters(self._cache_reports.get_nowait())
+            except Empty:
+                self._cache_reports = None
+
+    def restart(self):
+        r"""Stops the workers, new ones (e.g. with a new context) start on demand.
+
+        The cache is cleared, its results may come from the old context.
+        """
+        self.close()
+        if self.cache is not None:
+            self.cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        r"""Terminates the workers of a manager collected without being closed.
+
+        Collection may happen in any thread or at interpreter exit, so nothing is
+        joined and nothing runs in the workers.
+        """
+        if getattr(self, "_worker", None) is not None:
+            if self._worker_pid == os.getpid():
+                self._worker.__exit__(None, None, None)
+        if getattr(self, "_pool", None) is None or self._pool_pid != os.getpid():
+            return
+        self._pool.terminate()
+        if self.shared_memory:
+            self.transport.close()
+        if self._writer is not None:
+            self.writer_options["writer_queue"].put(None)
+
+    def tune_chunksize(self, func, items, task_size=1):
+        r"""Computes a probe of items in parallel to measure the per-item latency.
+
+        Args:
+            func (callable): worker function computing a single item (or batch)
+            items (iterator): items (or batches), the probe is consumed from it
+            task_size (int): number of source elements in an item
+
+        Returns:
+            tuple(list, int): computed probe and the chunk size for the rest
+        """
+        n_workers = self.n_workers
+        probe = list(islice(items, n_workers))
+        if not probe:
+            return [], 1
+        results = self.pool.map(partial(SequentialWorker.instance_timed, func), probe, 1)
+        probe, times = zip(*results)
+        per_item = max(sum(times) / len(times), 1e-9)
+        chunksize = max(1, int(self.chunk_seconds / per_item))
+        try:
+            n_tasks = -(-len(self.source_instance) // task_size)
+            remaining = n_tasks - len(probe)
+            chunksize = min(chunksize, max(1, remaining // (4 * n_workers)))
+        except TypeError:
+            pass
+        return list(probe), chunksize
+
+    def dispatch(self, func, items, chunksize, start=0):
+        if self.ordering == "strict":
+            return self.pool.imap(func, items, chunksize)
+        if self.ordering == "completion":
+            return self.pool.imap_unordered(func, items, chunksize)
+        return iter(
+            ReorderingIterator(
+                self.pool, func, items, chunksize, self.reorder_buffer, start
+            )
         )
 
-        return iter(PoolJoiningIterator(res_it, pool))
+    def fast_compute(self, keys=None):
+        r"""Computes the whole dataset in the pool of workers.
+
+        Args:
+            keys (tuple(str), optional): compute only the transforms needed for
+                these keys and return only them. Defaults to None (everything).
+
+        Returns:
+            iterator: computed elements
+        """
+        if keys is not None:
+            keys = tuple(keys)
+        self.register_versions([self.context], keys)
+        if self.stages.needs_constants(*(keys or ())):
+            self.reduce()
+        reducing = self.reducers and self.reductions is None
+        items = iter(self.wrapped_source_instance)
+        if reducing:
+            func = partial(SequentialWorker.instance_compute_reducing, keys)
+            items = batched(items, self.batch_size)
+        elif self.batch_size > 1:
+            func = partial(SequentialWorker.instance_compute_batch, keys)
+            items = batched(items, self.batch_size)
+        elif keys is not None:
+            func = partial(SequentialWorker.instance_compute_keys, keys)
+        else:
+            func = SequentialWorker.instance_compute_full
+        results = self.run(func, items, self.batch_size)
+        if reducing:
+            return self.reducing(results)
+        if self.batch_size > 1:
+            return chain.from_iterable(results)
+        return results
+
+    def reducing(self, results):
+        r"""Yields the elements of a pass, then finishes the reducers with it.
+
+        The accumulators of the tasks are combined as they arrive, see
+        :class:`dame.reducer.TreeCombiner`.
+        """
+        worker = self.worker
+        reducers = [worker.stage_instance(cls) for cls in self.reducers]
+        combiners = [TreeCombiner(reducer.combine) for reducer in reducers]
+        for items, accumulators in results:
+            for combiner, accumulator in zip(combiners, accumulators):
+                combiner.add(accumulator)
+            yield from items
+        reductions = {}
+        for reducer, combiner in zip(reducers, combiners):
+            accumulator = combiner.result() if combiner else reducer.start()
+            result = reducer.finish(accumulator)
+            worker.save_to_store(-1, reducer, result)
+            reductions.update(result)
+        self.set_reductions(reductions)
+
+    @property
+    def reductions(self):
+        r"""Results of all the reducers, loaded from the store on first use.
+
+        None until all of them are computed.
+        """
+        if self._reductions is None and self.reducers:
+            worker = self.worker
+            results = [
+                worker.load_from_store(-1, worker.stage_instance(reducer_cls))
+                for reducer_cls in self.reducers
+            ]
+            if all(result is not None for result in results):
+                self.set_reductions(dict(ChainMap(*results)))
+        return self._reductions
+
+    def set_reductions(self, reductions):
+        r"""Sets the constants of the transforms, running workers are restarted."""
+        self._reductions = reductions
+        if self._pool is not None:
+            self.close()
+        if self._worker is not None:
+            self._worker.constants = reductions
+
+    def reduce(self):
+        r"""Results of the reducers, computed in a pass over their requirements
+        unless loaded from the store.
+
+        Returns:
+            dict: `{key: value}` for the keys provided by all the reducers
+        """
+        if self.reducers and self.reductions is None:
+            keys = set(
+                chain.from_iterable(
+                    self.stages.get_requirements(reducer) for reducer in self.reducers
+                )
+            )
+            for _ in self.fast_compute(tuple(keys) or ("idx",)):
+                pass
+        return self._reductions or {}
+
+    def sweep(self, grid, keys=None):
+        r"""Computes the dataset in several configurations in a single pass.
+
+        The configurations are all the combinations of the grid's arguments, the
+        rest of the context stays as it is. Stages with the same arguments and
+        inputs in several configurations are computed once for all of them, see
+        :meth:`SequentialWorker.compute_sweep`.
+
+        Args:
+            grid (dict): `{Transform_cls: [{"args": [...], "kwargs": {...}}, ...]}`
+            keys (tuple(str), optional): see :meth:`fast_compute`
+
+        Returns:
+            iterator: for every element a list of its values in the
+                configurations, in the order of :meth:`sweep_contexts`
+        """
+        if keys is not None:
+            keys = tuple(keys)
+        if self.stages.needs_constants(*(keys or ())):
+            self.reduce()
+        contexts = self.sweep_contexts(grid)
+        self.register_versions(contexts, keys)
+        self._sweeps += 1
+        func = partial(
+            SequentialWorker.instance_compute_sweep, self._sweeps, contexts, keys
+        )
+        return self.run(func, iter(self.wrapped_source_instance))
+
+    def sweep_contexts(self, grid):
+        r"""Contexts of all the configurations of a grid, see :meth:`sweep`.
+
+        Returns:
+            list(dict): contexts in the order of :func:`itertools.product` over
+                the grid's arguments
+        """
+        names = [transform.__name__ for transform in grid]
+        return [
+            {**self.context, **dict(zip(names, variants))}
+            for variants in product(*grid.values())
+        ]
+
+    def compute_chunks(self, size, keys=None):
+        r"""Computes the dataset by chunks of consecutive elements.
+
+        Every transform processes a whole chunk before the next one starts, so its
+        state stays warm, and the store is accessed once per transform and chunk.
+        See :meth:`SequentialWorker.compute_columns`.
+
+        Args:
+            size (int): number of elements in a chunk
+            keys (tuple(str), optional): see :meth:`fast_compute`
+
+        Returns:
+            iterator: `{key: [values of the chunk's elements]}` for every chunk
+        """
+        assert size >= 1, "Wrong chunk size"
+        if keys is not None:
+            keys = tuple(keys)
+        self.register_versions([self.context], keys)
+        if self.stages.needs_constants(*(keys or ())):
+            self.reduce()
+        items = batched(iter(self.wrapped_source_instance), size)
+        func = partial(SequentialWorker.instance_compute_columns, keys)
+        return self.run(func, items, size)
+
+    def run(self, func, items, task_size=1):
+        r"""Maps func over the items in the pool of workers.
+
+        The results are sent back with the manager's transport, in the order of
+        its ordering, the items are sent in chunks of its chunksize.
+
+        Args:
+            func (callable): worker function, see ``SequentialWorker.instance_*``
+            items (iterator): its arguments
+            task_size (int): number of source elements in an item
+
+        Returns:
+            iterator: results of func
+        """
+        framed = self.transport == "pickle5" and self.executor == "process"
+        if framed:
+            func = partial(SequentialWorker.instance_framed, func)
+        elif self.shared_memory:
+            run = self.transport.open_run()
+            func = partial(SequentialWorker.instance_transported, func, run)
+        probe, chunksize = [], self.chunksize
+        if chunksize == "auto":
+            probe, chunksize = self.tune_chunksize(func, items, task_size)
+        results = chain(probe, self.dispatch(func, items, chunksize, len(probe)))
+        if framed:
+            results = map(serialization.unframe, results)
+        elif self.shared_memory:
+            results = self.transport.receiving(results, run)
+        return results
 
     def compute_one(self, idx):
-        with SequentialWorker(self.stages, self.context, global_store=self.store) as w:
-            return w.compute_full(self.wrapped_source_instance[idx])
+        r"""Computes a single element in the calling process, see :attr:`worker`."""
+        self.register_versions([self.context])
+        if self.stages.needs_constants():
+            self.reduce()
+        return self.worker.compute_full(self.wrapped_source_instance[idx])
@@ -15,11 +15,19 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     classifiers=[
         "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
         "Development Status :: 1 - Planning",
         "Topic :: Software Development"
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.8',
     install_requires=['numpy', 'peewee>=3'],
+    entry_points={
+        'console_scripts': ['dame-store=dame.maintenance:main'],
+    },
 )
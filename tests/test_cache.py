@@ -0,0 +1,45 @@
+import pickle
+
+import numpy as np
+
+from dame.cache import MemoryCache, result_nbytes
+
+
+def test_lru():
+    cache = MemoryCache(max_entries=2)
+    cache.put(("v", 0), {"a": 0})
+    cache.put(("v", 1), {"a": 1})
+    assert cache.get(("v", 0)) == {"a": 0}
+    cache.put(("v", 2), {"a": 2})
+    assert ("v", 1) not in cache
+    assert cache.get(("v", 0)) == {"a": 0}
+    assert cache.get(("v", 1)) is None
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+    assert cache.stats()["evictions"] == 1
+
+
+def test_ring():
+    cache = MemoryCache(max_entries=2, policy="ring")
+    cache.put(("v", 0), {"a": 0})
+    cache.put(("v", 1), {"a": 1})
+    assert cache.get(("v", 0)) == {"a": 0}
+    cache.put(("v", 2), {"a": 2})
+    assert ("v", 0) not in cache and len(cache) == 2
+
+
+def test_max_bytes():
+    array = {"a": np.zeros(1000)}
+    cache = MemoryCache(max_bytes=int(2.5 * result_nbytes(array)))
+    for idx in range(3):
+        cache.put(("v", idx), {"a": np.zeros(1000)})
+    assert len(cache) == 2 and ("v", 0) not in cache
+    assert cache.nbytes <= cache.max_bytes
+    cache.put(("v", 3), {"a": np.zeros(10000)})
+    assert ("v", 3) not in cache and len(cache) == 2
+
+
+def test_pickles_empty():
+    cache = MemoryCache(max_entries=2)
+    cache.put(("v", 0), {"a": 0})
+    copy = pickle.loads(pickle.dumps(cache))
+    assert len(copy) == 0 and copy.max_entries == 2
@@ -1,3 +1,6 @@
+import numpy as np
+
+from dame.reducer import Reducer
 from dame.versionable import Versionable
 
 
@@ -37,3 +40,45 @@ class ThreeNums:
 
     def __len__(self):
         return 3
+
+
+class BatchTimesTwo(Versionable):
+    provides = ("t2",)
+
+    def apply(self, *, p1):
+        raise NotImplementedError("Only batches!")
+
+    def apply_batch(self, *, p1):
+        return [{"t2": value * 2} for value in p1]
+
+
+class Ones(Versionable):
+    provides = ("ones",)
+
+    def apply(self, *, number):
+        return {"ones": [np.ones((number + 1, 1000)), {"small": np.ones(2)}]}
+
+
+class Mean(Reducer):
+    provides = ("mean",)
+
+    def start(self):
+        return 0, 0
+
+    def update(self, accumulator, *, number):
+        total, count = accumulator
+        return total + number, count + 1
+
+    def combine(self, first, second):
+        return first[0] + second[0], first[1] + second[1]
+
+    def finish(self, accumulator):
+        total, count = accumulator
+        return {"mean": total / count}
+
+
+class Centered(Versionable):
+    provides = ("centered",)
+
+    def apply(self, *, number, mean):
+        return {"centered": number - mean}
@@ -1,8 +1,13 @@
-from pytest import raises
+from tempfile import TemporaryDirectory
+
+from pytest import raises, warns
 
 from dame import Dataset
+from dame.cache import MemoryCache
+from dame.storage import PeeWeeStore, Result
+from dame.versionable import Versionable
 
-from .test_classes import ThreeNums, PlusOne, PlusTwo, PlusXN
+from .test_classes import ThreeNums, PlusOne, PlusTwo, PlusXN, Mean, Centered
 
 
 class StandardDataset(Dataset):
@@ -64,9 +69,216 @@ class OtherDataset(StandardDataset):
     transforms = (PlusOne, PlusXN)
 
 
+class Mapped(Versionable):
+    provides = ("mapped",)
+
+    def __init__(self, func):
+        self.func = func
+
+    def apply(self, *, p1):
+        return {"mapped": self.func(p1)}
+
+
+def test_callable_args():
+    class MappedDataset(StandardDataset):
+        transforms = (PlusOne, Mapped)
+        executor = "sequential"
+
+    data = MappedDataset()
+    # Not versioned without a store or a cache
+    data.set_arguments_for(Mapped, lambda x: x * 3)
+    assert [d["mapped"] for d in data] == [3, 6, 9]
+    with TemporaryDirectory() as tmpdir:
+        MappedDataset.store = PeeWeeStore
+        MappedDataset.context = {"PeeWeeStore": {"db_args": [f"{tmpdir}/db.sqlite3"]}}
+        with MappedDataset() as data:
+            data.set_arguments_for(Mapped, lambda x: x * 3)
+            with warns(UserWarning, match="Versionable"):
+                assert [d["mapped"] for d in data] == [3, 6, 9]
+
+
 def test_right_args():
     data = OtherDataset()
     data.set_arguments_for(PlusXN, 2, n=10)
     assert data[0] == {"number": 0, "p1": 1, "pxn": 1024, "idx": 0}
     data.set_arguments_for(PlusXN, 2, n=9)
     assert data[0] == {"number": 0, "p1": 1, "pxn": 512, "idx": 0}
+
+
+def test_restarts_on_new_arguments():
+    with OtherDataset() as data:
+        data.set_arguments_for(PlusXN, 2, n=10)
+        assert next(iter(data))["pxn"] == 1024
+        data.set_arguments_for(PlusXN, 2, n=9)
+        assert next(iter(data))["pxn"] == 512
+
+
+def test_select():
+    with StandardDataset() as data:
+        assert list(data.select("p1", "number")) == [
+            {"p1": d["p1"], "number": d["number"]} for d in full
+        ]
+
+
+def test_assequence_unknown_keys():
+    with StandardDataset() as data:
+        assert list(data.assequence({"p1", "unknown"})) == [
+            {"p1": d["p1"]} for d in full
+        ]
+        assert list(data.assequence("p1")) == [{"p1": d["p1"]} for d in full]
+        assert list(data.assequence({"unknown"})) == [{} for _ in full]
+        with raises(KeyError):
+            list(data.select("p1", "unknown"))
+
+
+def test_executors():
+    for executor in ("process", "thread", "sequential"):
+        with StandardDataset() as data:
+            data.executor = executor
+            data.n_processes = 2
+            assert list(data) == full
+            assert list(data.select("p2")) == [{"p2": d["p2"]} for d in full]
+
+
+def test_single_writer():
+    for executor in ("process", "thread"):
+        with TemporaryDirectory() as tmpdir:
+
+            class StoredDataset(StandardDataset):
+                store = PeeWeeStore
+                context = {"PeeWeeStore": {"db_args": [f"{tmpdir}/db.sqlite3"]}}
+                single_writer = True
+                n_processes = 2
+
+            StoredDataset.executor = executor
+            with StoredDataset() as data:
+                assert list(data) == full
+                assert data[1] == expected(1)
+            store = PeeWeeStore(())
+            store.open(f"{tmpdir}/db.sqlite3")
+            assert Result.select().count() == 6
+            store.close()
+
+
+def test_cache():
+    class CachedDataset(StandardDataset):
+        cache = MemoryCache()
+        executor = "thread"
+
+    with CachedDataset() as data:
+        assert data[1] == expected(1)
+        assert data[1] == expected(1)
+        assert data.cache.stats()["hits"] == 2
+        assert list(data.select("p2")) == [{"p2": d["p2"]} for d in full]
+        assert data.cache.stats()["hits"] == 3
+
+
+def test_cache_stats_of_process_workers():
+    class CachedDataset(StandardDataset):
+        cache = MemoryCache()
+        n_processes = 1
+
+    with CachedDataset() as data:
+        assert list(data) == full and list(data) == full
+        assert data.cache.stats()["hits"] == 0
+    stats = data.cache.stats()
+    assert stats["hits"] > 0 and stats["misses"] > 0 and not stats["entries"]
+
+
+def test_reuses_item_worker():
+    with TemporaryDirectory() as tmpdir:
+
+        class StoredDataset(StandardDataset):
+            store = PeeWeeStore
+            context = {"PeeWeeStore": {"db_args": [f"{tmpdir}/db.sqlite3"]}}
+
+        with StoredDataset() as data:
+            assert data[0] == expected(0)
+            worker = data.manager.worker
+            instances = worker.stage_instances
+            assert data[1] == expected(1)
+            assert data.manager.worker is worker
+            assert worker.stage_instances == instances
+        assert data.manager._worker is None
+        store = PeeWeeStore(())
+        store.open(f"{tmpdir}/db.sqlite3")
+        assert Result.select().count() == 4
+        store.close()
+
+
+def test_iter_chunks():
+    with StandardDataset() as data:
+        assert list(data.iter_chunks(2, "p2")) == [{"p2": [2, 3]}, {"p2": [4]}]
+        chunks = list(data.iter_chunks(3))
+        assert chunks == [{key: [d[key] for d in full] for key in full[0]}]
+
+
+def test_keep():
+    for batch_size in (1, 2):
+
+        class KeepingDataset(StandardDataset):
+            keep = ("p2",)
+
+        KeepingDataset.batch_size = batch_size
+        with KeepingDataset() as data:
+            assert data[1] == {"p2": 3, "idx": 1}
+            assert list(data) == [{"p2": d["p2"], "idx": d["idx"]} for d in full]
+
+
+def test_reducers():
+    with TemporaryDirectory() as tmpdir:
+
+        class ReducedDataset(StandardDataset):
+            reducers = (Mean,)
+            store = PeeWeeStore
+            context = {"PeeWeeStore": {"db_args": [f"{tmpdir}/db.sqlite3"]}}
+            n_processes = 2
+
+        with ReducedDataset() as data:
+            # Computed in the same pass as the elements
+            assert list(data) == full
+            assert data.manager._reductions == {"mean": 1}
+            assert data.reduce() == {"mean": 1}
+
+        class CenteredDataset(ReducedDataset):
+            transforms = (PlusOne, Centered)
+
+        with CenteredDataset() as data:
+            # Loaded from the store
+            assert data.reduce() == {"mean": 1}
+            assert [d["centered"] for d in data] == [-1, 0, 1]
+            assert data[2]["centered"] == 1
+            assert list(data.select("mean")) == [{"mean": 1}] * 3
+
+    class FreshDataset(StandardDataset):
+        transforms = (PlusOne, Centered)
+        reducers = (Mean,)
+        executor = "thread"
+
+    with FreshDataset() as data:
+        assert [d["centered"] for d in data.select("centered")] == [-1, 0, 1]
+
+
+def test_sweep():
+    for single_writer in (False, True):
+        with TemporaryDirectory() as tmpdir:
+
+            class SweptDataset(OtherDataset):
+                store = PeeWeeStore
+                context = {"PeeWeeStore": {"db_args": [f"{tmpdir}/db.sqlite3"]}}
+                executor = "thread"
+
+            # The versions of the grid are registered for the read-only workers
+            SweptDataset.single_writer = single_writer
+            grid = {PlusXN: [{"args": [2], "kwargs": {"n": n}} for n in (1, 2, 3)]}
+            with SweptDataset() as data:
+                contexts, results = data.sweep(grid, "pxn")
+                assert [c["PlusXN"]["kwargs"]["n"] for c in contexts] == [1, 2, 3]
+                assert list(results) == [
+                    [{"pxn": num + 2 ** n} for n in (1, 2, 3)] for num in range(3)
+                ]
+            store = PeeWeeStore(())
+            store.open(f"{tmpdir}/db.sqlite3")
+            # Stored separately for every configuration
+            assert Result.select().count() == 9
+            store.close()
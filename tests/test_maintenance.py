@@ -0,0 +1,105 @@
+from datetime import timedelta
+from tempfile import TemporaryDirectory
+
+from dame import Dataset
+from dame.maintenance import collect_garbage, main, retain
+from dame.storage import MmapStore, PeeWeeStore, Result, TransformModel
+
+from .test_classes import ThreeNums, PlusOne, PlusTwo, PlusXN, Ones
+
+
+def fill(path, store_cls, transforms, context=None):
+    class StoredDataset(Dataset):
+        source = ThreeNums()
+        store = store_cls
+        executor = "sequential"
+
+    StoredDataset.transforms = transforms
+    StoredDataset.context = {"PeeWeeStore": {"db_args": [path]}, **(context or {})}
+    StoredDataset.context[store_cls.__name__] = StoredDataset.context["PeeWeeStore"]
+    with StoredDataset() as data:
+        list(data)
+    return StoredDataset
+
+
+def test_collect_garbage():
+    with TemporaryDirectory() as tmpdir:
+        path = f"{tmpdir}/db.sqlite3"
+        old, new = ({"PlusXN": {"args": [x], "kwargs": {"n": 1}}} for x in (2, 3))
+        fill(path, PeeWeeStore, (PlusOne, PlusXN), old)
+        current = fill(path, PeeWeeStore, (PlusOne, PlusXN), new)
+        store = PeeWeeStore(())
+        store.open(path)
+        versions = store.versions()
+        assert [v["results"] for v in versions] == [3, 3, 3]
+        assert collect_garbage(store, [current()], dry_run=True).versions == 1
+        report = collect_garbage(store, [current()])
+        assert report.versions == 1 and report.results == 3 and report.nbytes > 0
+        assert Result.select().count() == 6
+        assert TransformModel.select().count() == 2
+        assert store.compact() >= 0
+        store.close()
+
+
+def test_retain():
+    with TemporaryDirectory() as tmpdir:
+        path = f"{tmpdir}/db.sqlite3"
+        fill(path, PeeWeeStore, (PlusOne, PlusTwo))
+        store = PeeWeeStore(())
+        store.open(path)
+        assert retain(store, max_age=timedelta(days=1)).versions == 0
+        report = retain(store, max_bytes=store.versions()[1]["nbytes"])
+        assert report.versions == 1
+        assert [v["name"] for v in store.versions()] == ["PlusTwo"]
+        assert retain(store, max_age=timedelta(0)).versions == 1
+        store.close()
+
+
+def test_retain_shared_blobs():
+    with TemporaryDirectory() as tmpdir:
+        path = f"{tmpdir}/db.sqlite3"
+        # x ** 0 == 1, the versions of PlusXN store the same results
+        for x in (2, 3):
+            fill(path, PeeWeeStore, (PlusOne, PlusXN), {"PlusXN": {"args": [x]}})
+        store = PeeWeeStore(())
+        store.open(path)
+        versions = store.versions()
+        first, second = [v for v in versions if v["name"] == "PlusXN"]
+        shared, total = first["nbytes"], store.exclusive_nbytes()
+        assert second["nbytes"] == shared
+        assert sum(v["nbytes"] for v in versions) == total + shared
+        assert store.exclusive_nbytes([first["id"]]) == 0
+        assert store.exclusive_nbytes([first["id"], second["id"]]) == shared
+        assert retain(store, max_bytes=total).versions == 0
+        # Deleting the oldest, the first PlusXN, frees nothing
+        report = retain(store, max_bytes=total - 1, dry_run=True)
+        assert report.versions == 2 and report.nbytes == total - shared
+        store.close()
+
+
+def test_mmap_shards():
+    with TemporaryDirectory() as tmpdir:
+        path = f"{tmpdir}/db.sqlite3"
+        fill(path, MmapStore, (Ones,))
+        store = MmapStore(())
+        store.open(path)
+        (version,) = store.versions()
+        assert version["nbytes"] > 3 * 8000
+        assert len(store.shard_files(version["id"])) == 1
+        assert store.compact() >= 0
+        assert len(store.shard_files(version["id"])) == 1
+        store.delete_versions([version["id"]])
+        assert store.shard_files(version["id"]) == []
+        store.close()
+
+
+def test_cli(capsys):
+    with TemporaryDirectory() as tmpdir:
+        path = f"{tmpdir}/db.sqlite3"
+        fill(path, PeeWeeStore, (PlusOne, PlusTwo))
+        main([path, "list"])
+        out = capsys.readouterr().out
+        assert "PlusOne" in out and "PlusTwo" in out
+        main([path, "retain", "--max-bytes", "0", "--compact"])
+        out = capsys.readouterr().out
+        assert "Deleted 2 versions, 6 results" in out and "Reclaimed" in out
@@ -0,0 +1,23 @@
+from dame.reducer import TreeCombiner, tree_combine
+
+
+def test_tree_combine():
+    calls = []
+
+    def combine(first, second):
+        calls.append((first, second))
+        return first + second
+
+    assert tree_combine(combine, [[1], [2], [3], [4], [5]]) == [1, 2, 3, 4, 5]
+    assert calls[:2] == [([1], [2]), ([3], [4])]
+    assert len(calls) == 4
+    assert tree_combine(combine, [[1]]) == [1]
+
+
+def test_tree_combiner_keeps_a_level_each():
+    combiner, kept = TreeCombiner(lambda first, second: first + second), 0
+    for num in range(1000):
+        combiner.add([num])
+        kept = max(kept, len(combiner.levels))
+    assert combiner.result() == list(range(1000))
+    assert kept <= 10
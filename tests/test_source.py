@@ -12,3 +12,32 @@ def test_hack_getitem():
     for _ in range(2):
         for j in range(10):
             assert src[j] == {"what": j + 10, "idx": j}
+
+
+class CountingSource(MockSource):
+    def __init__(self):
+        self.restarts = 0
+
+    def __iter__(self):
+        self.restarts += 1
+        return super().__iter__()
+
+
+def test_random_access_index():
+    for index, restarts in (("never", 5), ("always", 1), ("auto", 2)):
+        source = CountingSource()
+        src = SourceWrap(source, index=index, buffer_size=2)
+        assert src[9] == {"what": 19, "idx": 9}
+        for j in reversed(range(10)):
+            assert src[j] == {"what": j + 10, "idx": j}
+        assert src[5] == {"what": 15, "idx": 5}
+        assert source.restarts == restarts
+        src.close()
+
+
+def test_buffers_recent_items():
+    source = CountingSource()
+    src = SourceWrap(source, index="never", buffer_size=3)
+    for j in (3, 4, 2, 5, 4):
+        assert src[j] == {"what": j + 10, "idx": j}
+    assert source.restarts == 1
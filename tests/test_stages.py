@@ -1,6 +1,6 @@
 from dame.stages import Stages
 
-from .test_classes import PlusOne, PlusTwo, ThreeNums
+from .test_classes import PlusOne, PlusTwo, PlusXN, ThreeNums
 
 
 def test_dag():
@@ -10,3 +10,22 @@ def test_dag():
         PlusTwo,
     ]
     assert list(stages.to("p1")) == [PlusOne]
+
+
+def test_plan():
+    stages = Stages(ThreeNums, (PlusTwo, PlusOne))
+    plan = stages.plan("p2")
+    assert [step.transform for step in plan] == [PlusOne, PlusTwo]
+    assert plan[1].requires == ("p1",) and plan[1].provides == ("p2",)
+    assert stages.plan("p2") is plan
+    assert [step.transform for step in stages.plan()] == [PlusOne, PlusTwo]
+
+
+def test_releases():
+    stages = Stages(ThreeNums, (PlusTwo, PlusOne, PlusXN))
+    plan = stages.plan()
+    releases = dict(zip([step.transform for step in plan], stages.releases(("p2",))))
+    assert releases[PlusTwo] == ("p1",)
+    assert releases[PlusXN] == ("pxn",)
+    assert "p1" not in releases[PlusOne]
+    assert stages.releases(("p2",), "p2") == (("number",), ("p1",))
@@ -1,13 +1,26 @@
 from contextlib import contextmanager
 from tempfile import TemporaryDirectory
 from io import BytesIO
+from multiprocessing import Barrier, Process
+from queue import Queue
 import pickle
+import sqlite3
 
 import numpy as np
+from peewee import OperationalError
+from pytest import raises
 
-from dame.storage import PeeWeeStore, NumpyPlaceholder
+from dame import compression
+from dame.storage import (
+    Blob,
+    MmapStore,
+    NumpyPlaceholder,
+    PeeWeeStore,
+    Result,
+    TransformModel,
+)
 
-from .test_classes import PlusXN
+from .test_classes import PlusXN, PlusOne
 
 
 @contextmanager
@@ -16,17 +29,17 @@ def tmp_db_path():
         yield f"{tmpdir}/db.sqlite3"
 
 
-def test_separate_numpy_data():
+def test_blobs_nested_arrays():
     r1, r2 = np.random.rand(2, 10)
-    data = {"a": 1, "na": r1, "b": 2, "nb": r2}
-    newdata, np_data = PeeWeeStore.separate_numpy_data(data)
-    assert newdata["a"] == 1 and newdata["b"] == 2
-    assert (np_data == [r1, r2]) or (np_data == [r2, r1])
-    assert isinstance(newdata["na"], NumpyPlaceholder) and isinstance(
-        newdata["nb"], NumpyPlaceholder
-    )
-    assert np.all(np_data[newdata["na"].num] == r1)
-    assert np.all(np_data[newdata["nb"].num] == r2)
+    fortran = np.asfortranarray(r1[:8].reshape(2, 4))
+    data = {"a": 1, "na": r1, "nested": {"b": [2, r2], "f": fortran}}
+    data_blob, np_blob = PeeWeeStore.get_blobs(data)
+    assert r1.tobytes() not in data_blob and r2.tobytes() not in data_blob
+    unpacked = PeeWeeStore.unpack_blobs(data_blob, bytes(np_blob))
+    assert np.all(unpacked["na"] == r1) and unpacked["na"].flags.writeable
+    assert np.all(unpacked["nested"]["b"][1] == r2) and unpacked["nested"]["b"][0] == 2
+    assert np.all(unpacked["nested"]["f"] == fortran)
+    assert PeeWeeStore.unpack_blobs(*PeeWeeStore.get_blobs({"a": 1})) == {"a": 1}
 
 
 def test_unpack_blobs():
@@ -60,3 +73,326 @@ def test_storage():
         del recv["random"]
         del data["random"]
         assert recv == data
+
+
+def test_storage_many():
+    with tmp_db_path() as db_path:
+        transform = PlusXN(3)
+        store = PeeWeeStore((transform,))
+        store.open(db_path, pragmas={"foreign_keys": 1})
+        store.save_many([0, 2], transform, [{"foo": 0}, {"foo": 2}])
+        assert store.load_many([0, 1, 2], transform) == [{"foo": 0}, None, {"foo": 2}]
+        store.close()
+
+
+def test_snapshot():
+    with tmp_db_path() as db_path:
+        plus_xn, plus_one = PlusXN(3), PlusOne()
+        store = PeeWeeStore((plus_xn, plus_one))
+        store.open(db_path, pragmas={"foreign_keys": 1})
+        store.save_many([0, 1, 3], plus_xn, [{"pxn": 0}, {"pxn": 1}, {"pxn": 3}])
+        store.save(1, plus_one, {"p1": 2})
+        for idxs in ([0, 1], [1, 3]):
+            snapshot = store.snapshot(idxs, (plus_xn, plus_one))
+            assert snapshot.load(1, plus_xn) == {"pxn": 1}
+            assert snapshot.load(1, plus_one) == {"p1": 2}
+            assert snapshot.load(3, plus_one) is None
+            assert (2, plus_xn) not in snapshot
+        store.close()
+
+
+def test_buffered_upserts():
+    with tmp_db_path() as db_path:
+        transform = PlusXN(3)
+        store = PeeWeeStore((transform,), flush_size=3, flush_interval=60)
+        store.open(db_path, pragmas={"foreign_keys": 1})
+        store.save(0, transform, {"foo": 0})
+        store.save(0, transform, {"foo": 1})
+        assert store.load(0, transform) == {"foo": 1}
+        assert Result.select().count() == 0
+        store.save_many([1, 2], transform, [{"foo": 1}, {"foo": 2}])
+        assert Result.select().count() == 3 and not store.pending
+        store.save(1, transform, {"foo": 3})
+        store.close()
+        store.open(db_path, pragmas={"foreign_keys": 1})
+        assert store.load_many([0, 1], transform) == [{"foo": 1}, {"foo": 3}]
+        assert Result.select().count() == 3
+        store.close()
+
+
+def test_mmap_storage():
+    with tmp_db_path() as db_path:
+        transform = PlusXN(3)
+        store = MmapStore((transform,), alignment=64)
+        store.open(db_path, pragmas={"foreign_keys": 1})
+        data = {
+            "r": np.random.rand(5, 3),
+            "i": np.arange(7, dtype=np.int16),
+            "o": np.array([None, 1]),
+            "e": np.zeros((0, 2)),
+            "foo": "bar",
+        }
+        store.save_many([0, 1], transform, [data, {"r": data["r"] + 1}])
+        store.flush()
+        recv, recv1 = store.load_many([0, 1], transform)
+        assert not recv["r"].flags.owndata
+        assert np.all(recv["r"] == data["r"]) and np.all(recv1["r"] == data["r"] + 1)
+        assert np.all(recv["i"] == data["i"]) and recv["i"].dtype == np.int16
+        assert list(recv["o"]) == [None, 1] and recv["e"].shape == (0, 2)
+        assert recv["foo"] == "bar"
+        assert not recv["r"].flags.writeable
+        store.close()
+
+
+def test_mmap_compact():
+    with tmp_db_path() as db_path:
+        transform = PlusXN(3)
+        store = MmapStore((transform,))
+        store.open(db_path)
+        store.save_many([0, 1], transform, [{"a": np.zeros(1000)}, {"a": np.ones(10)}])
+        store.save(0, transform, {"a": np.arange(5)})
+        store.flush()
+        # The first array of row 0 is no longer referenced
+        (shard,) = store.shard_files(store.transform_id(transform))
+        assert store.compact() >= 8000
+        assert store.shard_files(store.transform_id(transform)) != [shard]
+        recv, recv1 = store.load_many([0, 1], transform)
+        assert list(recv["a"]) == list(range(5)) and list(recv1["a"]) == [1] * 10
+        # Nothing left to reclaim
+        (shard,) = store.shard_files(store.transform_id(transform))
+        store.compact()
+        assert store.shard_files(store.transform_id(transform)) == [shard]
+        store.close()
+
+
+def test_mmap_compact_live_writer():
+    with tmp_db_path() as db_path:
+        transform = PlusXN(3)
+        writer, store = MmapStore((transform,)), MmapStore((transform,))
+        writer.open(db_path)
+        store.open(db_path)
+        writer.save_many([0, 1], transform, [{"a": np.zeros(1000)}] * 2)
+        writer.save(0, transform, {"a": np.arange(5)})
+        writer.flush()
+        # The shard of the writer is still appended to, it stays
+        (shard,) = store.shard_files(store.transform_id(transform))
+        store.compact()
+        assert store.shard_files(store.transform_id(transform)) == [shard]
+        writer.save(2, transform, {"a": np.ones(10)})
+        writer.close()
+        assert store.compact() >= 8000
+        assert shard not in store.shard_files(store.transform_id(transform))
+        recv, recv1, recv2 = store.load_many([0, 1, 2], transform)
+        assert list(recv["a"]) == list(range(5)) and list(recv1["a"]) == [0] * 1000
+        assert list(recv2["a"]) == [1] * 10
+        # A reopened writer appends to a new shard
+        writer.open(db_path)
+        writer.save(3, transform, {"a": np.arange(3)})
+        writer.close()
+        assert list(store.load(3, transform)["a"]) == list(range(3))
+        store.close()
+
+
+def test_mmap_reads_peewee_rows(monkeypatch):
+    # Compressed payloads may start like the pickled references of MmapStore
+    prefixed = (lambda data: b"\x80" + data, lambda data: data[1:])
+    monkeypatch.setitem(compression.CODECS, "prefixed", prefixed)
+    with tmp_db_path() as db_path:
+        data = {"r": np.arange(5), "foo": "bar"}
+        store = PeeWeeStore((), codecs={"PlusOne": "prefixed"})
+        store.open(db_path)
+        store.save(0, PlusOne(), data)
+        store.save(0, PlusXN(3), data)
+        store.close()
+        store = MmapStore(())
+        store.open(db_path)
+        store.save(1, PlusOne(), data)
+        for idx, transform in ((0, PlusOne()), (0, PlusXN(3)), (1, PlusOne())):
+            loaded = store.load(idx, transform)
+            assert np.all(loaded["r"] == data["r"]) and loaded["foo"] == "bar"
+        store.close()
+
+
+def test_codecs():
+    with tmp_db_path() as db_path:
+        transform, other = PlusXN(3), PlusOne()
+        data = {"zeros": np.zeros(10000), "meta": "a" * 1000, "small": 1}
+        codecs = {"PlusXN": "zlib", "*": {"meta": "lzma"}}
+        for store_cls in (PeeWeeStore, MmapStore):
+            store = store_cls((), codecs=codecs)
+            store.open(db_path)
+            store.save(0, transform, data)
+            store.save(0, other, data)
+            store.flush()
+            query = Result.select_payloads(Result.origin)
+            rows = {r.origin_id: r.payload() for r in query}
+            mmap = store_cls is MmapStore
+            pickled, numpy_data, codec = rows[store.transform_id(transform)]
+            assert codec == ("mmap:zlib" if mmap else "zlib")
+            if not mmap:
+                assert len(numpy_data) < 1000
+            pickled, _, codec = rows[store.transform_id(other)]
+            assert codec == ("mmap" if mmap else None)
+            assert b"a" * 1000 not in pickled
+            store.close()
+            # Stays readable with other codecs
+            store = store_cls((), codecs={"*": "bz2"})
+            store.open(db_path)
+            for t in (transform, other):
+                loaded = store.load(0, t)
+                assert np.all(loaded["zeros"] == 0) and loaded["meta"] == data["meta"]
+                assert loaded["small"] == 1
+            store.close()
+
+
+def test_migrates_baseline_duplicates():
+    with tmp_db_path() as db_path:
+        db = sqlite3.connect(db_path)
+        # The schema of the first versions, results were inserted without upserts
+        db.executescript(
+            """
+            CREATE TABLE transformmodel (id INTEGER NOT NULL PRIMARY KEY,
+                name VARCHAR(128) NOT NULL, digest VARCHAR(128) NOT NULL,
+                version DATETIME NOT NULL);
+            CREATE TABLE result (id INTEGER NOT NULL PRIMARY KEY,
+                origin_id INTEGER NOT NULL, dataset_index INTEGER NOT NULL,
+                pickled_data BLOB NOT NULL, numpy_data BLOB,
+                FOREIGN KEY (origin_id) REFERENCES transformmodel (id));
+            CREATE INDEX result_origin_id ON result (origin_id);
+            """
+        )
+        db.execute(
+            "INSERT INTO transformmodel VALUES (1, 'PlusOne', ?, '2020-01-01')",
+            (PlusOne().version(),),
+        )
+        for num, idx in ((1, 0), (2, 0), (3, 1)):
+            db.execute(
+                "INSERT INTO result (origin_id, dataset_index, pickled_data)"
+                " VALUES (1, ?, ?)",
+                (idx, pickle.dumps({"p1": num})),
+            )
+        db.commit()
+        db.close()
+        store = PeeWeeStore(())
+        store.open(db_path)
+        assert Result.select().count() == 2
+        assert store.load_many([0, 1], PlusOne()) == [{"p1": 2}, {"p1": 3}]
+        store.save(0, PlusOne(), {"p1": 4})
+        assert store.load(0, PlusOne()) == {"p1": 4}
+        store.close()
+
+
+def test_adds_codec_column():
+    with tmp_db_path() as db_path:
+        store = PeeWeeStore(())
+        store.open(db_path)
+        store.save(0, PlusOne(), {"p1": 1})
+        store.flush()
+        store.db.execute_sql("ALTER TABLE result DROP COLUMN codec")
+        store.close()
+        store = PeeWeeStore(())
+        store.open(db_path)
+        assert store.load(0, PlusOne()) == {"p1": 1}
+        store.close()
+
+
+def test_deduplication():
+    with tmp_db_path() as db_path:
+        store = PeeWeeStore(())
+        store.open(db_path)
+        data = {"zeros": np.zeros(1000), "meta": "a"}
+        for idx in range(3):
+            store.save(idx, PlusOne(), data)
+            store.save(idx, PlusXN(3), data)
+        store.save(3, PlusOne(), {"zeros": np.ones(1000), "meta": "a"})
+        store.flush()
+        assert Blob.select().count() == 2 and Result.select().count() == 7
+        store.save(4, PlusOne(), data)
+        store.flush()
+        assert Blob.select().count() == 2
+        assert np.all(store.load(4, PlusOne())["zeros"] == 0)
+        assert np.all(store.load(3, PlusOne())["zeros"] == 1)
+        # Overwriting a result points it to the new payload
+        store.save(0, PlusXN(3), {"meta": "b"})
+        assert store.load(0, PlusXN(3)) == {"meta": "b"}
+        versions = {v["name"]: v for v in store.versions()}
+        store.delete_versions([versions["PlusXN"]["id"]])
+        assert Blob.select().count() == 2
+        store.delete_versions([versions["PlusOne"]["id"]])
+        assert Blob.select().count() == 0
+        store.close()
+
+
+def write_payloads(db_path, transform, barrier):
+    store = PeeWeeStore((), flush_size=1)
+    store.open(db_path)
+    barrier.wait()
+    for idx in range(50):
+        store.save(idx, transform, {"value": np.full(100, idx % 5)})
+    store.close()
+
+
+def test_concurrent_deduplication():
+    with tmp_db_path() as db_path:
+        store = PeeWeeStore(())
+        store.open(db_path)
+        # Every flush of the two processes writes the same payloads
+        barrier = Barrier(2)
+        writers = [
+            Process(target=write_payloads, args=(db_path, transform, barrier))
+            for transform in (PlusOne(), PlusXN(3))
+        ]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        assert [writer.exitcode for writer in writers] == [0, 0]
+        assert Blob.select().count() == 5 and Result.select().count() == 100
+        assert np.all(store.load(7, PlusXN(3))["value"] == 2)
+        store.close()
+
+
+def test_read_only_with_writer_queue():
+    with tmp_db_path() as db_path:
+        writer = PeeWeeStore((PlusOne(),))
+        writer.open(db_path)
+        writer.transform_ids
+        queue = Queue()
+        store = PeeWeeStore((), writer_queue=queue)
+        store.open(db_path)
+        store.save(0, PlusOne(), {"p1": 1})
+        store.flush()
+        (row,) = queue.get_nowait()
+        assert row["origin"] == writer.transform_id(PlusOne())
+        with raises(LookupError):
+            store.transform_id(PlusXN(3))
+        with raises(OperationalError, match="readonly"):
+            TransformModel.create(name="PlusXN", digest="0" * 64)
+        store.close()
+        writer.close()
+
+
+def test_adds_blob_column():
+    with tmp_db_path() as db_path:
+        store = PeeWeeStore((), dedup=False)
+        store.open(db_path)
+        store.save(0, PlusOne(), {"p1": 1})
+        store.flush()
+        assert Blob.select().count() == 0
+        # The result table of older versions
+        for sql in (
+            "CREATE TABLE old AS SELECT id, origin_id, dataset_index, pickled_data,"
+            " numpy_data, codec FROM result",
+            "DROP TABLE result",
+            "ALTER TABLE old RENAME TO result",
+            "CREATE UNIQUE INDEX result_origin ON result (origin_id, dataset_index)",
+        ):
+            store.db.execute_sql(sql)
+        store.close()
+        store = PeeWeeStore(())
+        store.open(db_path)
+        assert store.load(0, PlusOne()) == {"p1": 1}
+        store.save(1, PlusOne(), {"p1": 1})
+        store.flush()
+        assert store.load(1, PlusOne()) == {"p1": 1}
+        store.close()
@@ -2,9 +2,15 @@
 from tempfile import TemporaryDirectory
 from pathlib import Path
 from importlib import import_module, reload
+import ast
 import fileinput
+import json
+import sys
 
+import numpy as np
+import pytest
 
+from dame import versionable
 from dame.versionable import Versionable, Unversionable
 
 
@@ -115,6 +121,34 @@ def test_version_str():
     assert x.version() == y.version()
 
 
+def test_stable_digest():
+    a, b = np.zeros(10_000), np.zeros(10_000)
+    b[5_000] = 1
+    assert repr(a) == repr(b)
+    assert versionable.stable_digest(a) != versionable.stable_digest(b)
+    assert versionable.stable_digest(a) == versionable.stable_digest(a.copy())
+    assert versionable.stable_digest(a) != versionable.stable_digest(a.astype("f4"))
+    assert versionable.stable_digest({"a": 1, "b": [2]}) == versionable.stable_digest(
+        {"b": [2], "a": 1}
+    )
+    assert versionable.stable_digest((1,)) != versionable.stable_digest(("1",))
+    x = X()
+    assert versionable.stable_digest({"x": x}) == versionable.stable_digest({"x": X()})
+    x.__version_str__ = "1"
+    assert versionable.stable_digest({"x": x}) != versionable.stable_digest({"x": X()})
+
+
+def test_unstable_params():
+    x, y = X(), X()
+    x.register_params(model=object())
+    y.register_params(model=object())
+    with pytest.warns(UserWarning, match="Versionable"):
+        assert x.version() == y.version()
+    y.register_params(model=len)
+    with pytest.warns(UserWarning):
+        assert x.version() != y.version()
+
+
 class Z(Unversionable):
     pass
 
@@ -122,3 +156,59 @@ class Z(Unversionable):
 def test_unversionable():
     p, q = Z(), Z()
     assert p.version() != q.version()
+
+
+def test_cosmetic_changes():
+    code = "def whatever(self):\n    return 1  # one"
+    with tmp_module("transC", make_versionable("Doc", {}, code)) as ta:
+        ver1 = ta.TestT().version()
+    code = "def whatever(self):\n    '''New doc.'''\n\n    return (1)"
+    with tmp_module("transD", make_versionable("Other doc", {}, code)) as ta:
+        assert ta.TestT().version() == ver1
+    code = "def whatever(self):\n    return 2"
+    with tmp_module("transE", make_versionable("Doc", {}, code)) as ta:
+        assert ta.TestT().version() != ver1
+
+
+def test_memoized():
+    x = X()
+    assert x.version() is x.version()
+    version = x.version()
+    x.register_params(a=1)
+    assert x.version() != version
+
+
+def test_disk_cache(monkeypatch):
+    with TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / "versions.json"
+        monkeypatch.setenv(versionable.CACHE_ENV, str(path))
+        monkeypatch.setattr(versionable, "_digests", {})
+        monkeypatch.setattr(versionable, "_disk_cache", None)
+        version = X().version()
+        assert len(json.loads(path.read_text())) == 1
+        # Digests come from the file in a new process
+        monkeypatch.setattr(versionable, "_digests", {})
+        monkeypatch.setattr(versionable, "_disk_cache", None)
+        monkeypatch.setattr(versionable, "source_digest", None)
+        assert X().version() == version
+        # Other Python versions may parse the file differently
+        (key,) = json.loads(path.read_text())
+        assert key.startswith("{}.{}:".format(*sys.version_info[:2]))
+
+
+def legacy_node(name, *fields):
+    return type(name, (ast.AST,), {"_fields": fields})
+
+
+def test_normalized_ast():
+    # Nodes of older Python versions
+    Str, Index = legacy_node("Str", "s"), legacy_node("Index", "value")
+    docstring = ast.Expr(value=Str(s="Doc."))
+    tree = ast.Module(body=[docstring, ast.parse("x[1]").body[0]], type_ignores=[])
+    tree.body[1].value.slice = Index(value=ast.Constant(value=1))
+    versionable.strip_docstrings(tree)
+    assert versionable.normalized_ast(tree) == versionable.normalized_ast(
+        ast.parse("x[1]")
+    )
+    assert versionable.source_digest("x = u'a'") == versionable.source_digest("x = 'a'")
+    assert versionable.source_digest("x = 1") != versionable.source_digest("x = 1.0")
@@ -1,7 +1,22 @@
-from dame.worker import SequentialWorker, WorkManager
+from functools import partial
+from multiprocessing.reduction import ForkingPickler
+from tempfile import TemporaryDirectory
+import gc
+import pickle
+import sys
+import tracemalloc
+
+import numpy as np
+
+from dame import serialization
+from dame.cache import MemoryCache
+from dame.storage import PeeWeeStore, Result
+from dame.versionable import Versionable
+from dame.transport import SharedMemoryTransport
+from dame.worker import SequentialPool, SequentialWorker, WorkManager
 from dame.stages import Stages
 from dame.source import SourceWrap
-from .test_classes import ThreeNums, PlusOne, PlusTwo, PlusXN
+from .test_classes import ThreeNums, PlusOne, PlusTwo, PlusXN, BatchTimesTwo, Ones
 
 
 class MockStages(Stages):
@@ -78,7 +93,325 @@ def test_uses_store(capfd):
 
     for i in manager.fast_compute():
         pass
+    manager.close()
 
     out = capfd.readouterr()
     expected_out = "Opening\nLoading 0.PlusXN\nSaving 0.PlusXN\nLoading 0.PlusOne\nReturning\nLoading 0.PlusTwo\nReturning\nLoading 1.PlusXN\nSaving 1.PlusXN\nLoading 1.PlusOne\nSaving 1.PlusOne\nLoading 1.PlusTwo\nSaving 1.PlusTwo\nLoading 2.PlusXN\nSaving 2.PlusXN\nLoading 2.PlusOne\nSaving 2.PlusOne\nLoading 2.PlusTwo\nSaving 2.PlusTwo\nFinalizing\n"
     assert out.out == expected_out
+
+
+def test_reuses_pool():
+    manager = WorkManager(ThreeNums(), (PlusOne, PlusTwo), {}, n_processes=1)
+    with manager:
+        pool = manager.pool
+        assert [d["p2"] for d in manager.fast_compute()] == [2, 3, 4]
+        assert [d["p2"] for d in manager.fast_compute()] == [2, 3, 4]
+        assert manager.pool is pool
+    assert manager._pool is None
+
+
+def test_collected_without_close(monkeypatch):
+    unraisable = []
+    monkeypatch.setattr(sys, "unraisablehook", unraisable.append)
+    try:
+        WorkManager(ThreeNums(), (PlusOne,), {}, ordering="bogus")
+    except AssertionError:
+        pass
+    for executor in WorkManager.executors:
+        manager = WorkManager(
+            ThreeNums(), (PlusOne, PlusTwo), {}, n_processes=1, executor=executor
+        )
+        assert [d["p2"] for d in manager.fast_compute()] == [2, 3, 4]
+        pool = manager.pool
+        del manager
+        gc.collect()
+        assert not unraisable
+        assert getattr(pool, "_state", None) != "RUN"
+
+
+def test_chunks_and_orderings():
+    for chunksize in (1, 2, "auto"):
+        for ordering in WorkManager.orderings:
+            with WorkManager(
+                ThreeNums(),
+                (PlusOne, PlusTwo),
+                {},
+                n_processes=2,
+                chunksize=chunksize,
+                ordering=ordering,
+                reorder_buffer=1,
+            ) as manager:
+                res = [d["p2"] for d in manager.fast_compute()]
+            if ordering == "completion":
+                res = sorted(res)
+            assert res == [2, 3, 4]
+
+
+class FiftyNums:
+    provides = ("number",)
+
+    def __getitem__(self, idx):
+        if idx >= 50 or idx < 0:
+            raise IndexError
+        return {"number": idx}
+
+    def __len__(self):
+        return 50
+
+
+def test_interleaved_reordering():
+    for executor in WorkManager.executors:
+        with WorkManager(
+            FiftyNums(),
+            (PlusOne,),
+            {},
+            n_processes=2,
+            ordering="reorder",
+            reorder_buffer=4,
+            executor=executor,
+        ) as manager:
+            pairs = zip(manager.fast_compute(), manager.fast_compute())
+            expected = [(i, i) for i in range(1, 51)]
+            assert [(a["p1"], b["p1"]) for a, b in pairs] == expected
+            abandoned = manager.fast_compute()
+            next(abandoned)
+            assert [d["p1"] for d in manager.fast_compute()] == list(range(1, 51))
+            next(manager.fast_compute())
+        # Closed with an abandoned iteration
+
+
+def test_shared_memory_abandoned_iteration():
+    transport = SharedMemoryTransport(segments=8, segment_size=2 ** 19, threshold=1024)
+    with WorkManager(
+        FiftyNums(), (Ones,), {}, n_processes=2, transport=transport
+    ) as manager:
+        # Its other items are computed, their segments are never received
+        next(manager.fast_compute())
+        for _ in range(2):
+            results = list(manager.fast_compute())
+            segments = [np.frombuffer(seg.buf, np.uint8) for seg in transport.segments]
+            shared = [
+                any(np.shares_memory(d["ones"][0], seg) for seg in segments)
+                for d in results
+            ]
+            del segments, results
+            gc.collect()
+        assert any(shared)
+        transport.reclaim()
+        assert not any(transport.owners)
+
+
+def test_compute_keys():
+    stages = Stages(ThreeNums(), (PlusOne, PlusTwo, PlusXN))
+    worker = SequentialWorker(stages, {})
+    source = SourceWrap(ThreeNums())
+    assert worker.compute_keys(source[1], ("p1", "idx")) == {"p1": 2, "idx": 1}
+    assert PlusXN not in [type(s) for s, _, _ in worker.compiled_plan("p2")]
+
+
+def test_compute_batch():
+    stages = Stages(ThreeNums(), (PlusOne, BatchTimesTwo))
+    worker = SequentialWorker(stages, {})
+    source = SourceWrap(ThreeNums())
+    items = worker.compute_batch([source[1], source[2]], ("t2",))
+    assert items == [{"t2": 4}, {"t2": 6}]
+    assert worker.compute_columns([source[1], source[2]], ("p1", "t2")) == {
+        "p1": [2, 3],
+        "t2": [4, 6],
+    }
+    with WorkManager(ThreeNums(), (PlusOne, BatchTimesTwo), {}, batch_size=2) as m:
+        assert [d["t2"] for d in m.fast_compute()] == [2, 4, 6]
+
+
+def test_skips_stages_covered_by_store():
+    with TemporaryDirectory() as tmpdir:
+        stages = Stages(ThreeNums(), (PlusOne, PlusTwo))
+        context = {"PeeWeeStore": {"db_args": [f"{tmpdir}/db.sqlite3"]}}
+        source = SourceWrap(ThreeNums())
+        with SequentialWorker(stages, context, global_store=PeeWeeStore) as worker:
+            worker.store.save(0, worker.stage_instance(PlusTwo), {"p2": 42})
+            assert worker.compute_keys(source[0], ("p2",)) == {"p2": 42}
+            assert worker.compute_batch([source[0], source[1]], ("p2",)) == [
+                {"p2": 42},
+                {"p2": 3},
+            ]
+            assert worker.store.load(0, worker.stage_instance(PlusOne)) is None
+            assert worker.store.load(1, worker.stage_instance(PlusOne)) == {"p1": 2}
+
+
+def test_cache_in_front_of_store(capfd):
+    stages = Stages(ThreeNums(), (PlusOne, PlusTwo))
+    source = SourceWrap(ThreeNums())
+    cache = MemoryCache(max_entries=3)
+    with SequentialWorker(stages, {}, MockStorage, cache=cache) as worker:
+        worker.compute_full(source[1])
+        capfd.readouterr()
+        assert worker.compute_full(source[1])["p2"] == 3
+        assert worker.compute_keys(source[1], ("p2",)) == {"p2": 3}
+        assert worker.compute_batch([source[1]], ("p2",)) == [{"p2": 3}]
+        # Nothing reaches the store, only the cached stage of keys is loaded
+        assert capfd.readouterr().out == ""
+        assert cache.stats()["hits"] == 4
+        # The least recently used result is evicted
+        worker.compute_full(source[2])
+        assert len(cache) == 3
+        assert worker.cache_key(1, worker.stage_instance(PlusOne)) not in cache
+
+
+class CountingPlusOne(PlusOne):
+    calls = 0
+
+    def apply(self, *, number):
+        CountingPlusOne.calls += 1
+        return super().apply(number=number)
+
+
+def test_compute_sweep():
+    stages = Stages(ThreeNums(), (CountingPlusOne, PlusTwo, PlusXN))
+    source = SourceWrap(ThreeNums())
+    contexts = [
+        {"PlusXN": {"args": [10], "kwargs": {"n": n}}, "PlusTwo": {}} for n in (1, 2)
+    ]
+    worker = SequentialWorker(stages, {})
+    results = worker.compute_sweep(source[1], contexts)
+    assert [d["pxn"] for d in results] == [11, 101]
+    assert [d["p2"] for d in results] == [3, 3]
+    assert CountingPlusOne.calls == 1
+    assert worker.compute_sweep(source[2], contexts, ("pxn",)) == [
+        {"pxn": 12},
+        {"pxn": 102},
+    ]
+
+
+def test_sweep_contexts_of_every_task():
+    stages = Stages(ThreeNums(), (PlusOne, PlusTwo, PlusXN))
+    pool = SequentialPool(SequentialWorker.make_instance, (stages, {}, None, False))
+    contexts = [{"PlusXN": {"args": [10], "kwargs": {"n": n}}} for n in (1, 2)]
+    for idx in range(3):
+        # Unpickled anew for every task of a process pool
+        copy = pickle.loads(pickle.dumps(contexts))
+        func = partial(SequentialWorker.instance_compute_sweep, 1, copy, ("pxn",))
+        assert pool.call(func, SourceWrap(ThreeNums())[idx]) == [
+            {"pxn": idx + 10},
+            {"pxn": idx + 100},
+        ]
+    assert len(pool.worker._stage_instances) == 2
+
+
+def test_array_arguments():
+    stages = Stages(ThreeNums(), (PlusOne, PlusXN))
+    x, y = np.zeros(10_000), np.zeros(10_000)
+    y[5_000] = 1
+    contexts = [{"PlusXN": {"args": [x], "kwargs": {"n": 1}}} for x in (x, y)]
+    worker = SequentialWorker(stages, {})
+    first, second = [worker.stage_instance(PlusXN, context) for context in contexts]
+    assert first is not second
+    assert first.version() != second.version()
+    results = worker.compute_sweep(SourceWrap(ThreeNums())[0], contexts, ("pxn",))
+    assert [d["pxn"][5_000] - d["pxn"][0] for d in results] == [0, 1]
+
+
+class Doubled(Versionable):
+    provides = ("doubled",)
+
+    def apply(self, *, pxn):
+        return {"doubled": 2 * pxn}
+
+
+def test_upstream_aware_versions():
+    with TemporaryDirectory() as tmpdir:
+        stages = Stages(ThreeNums(), (PlusXN, Doubled, PlusOne))
+        source = SourceWrap(ThreeNums())
+        counts, versions = [], []
+        for x in (2, 3):
+            context = {
+                "PlusXN": {"args": [x]},
+                "PeeWeeStore": {"db_args": [f"{tmpdir}/db.sqlite3"]},
+            }
+            with SequentialWorker(stages, context, PeeWeeStore) as worker:
+                for idx in range(3):
+                    assert worker.compute_full(source[idx])["doubled"] == 2 * (idx + 1)
+                versions.append(
+                    [worker.stage_instance(t).version() for t in (PlusOne, Doubled)]
+                )
+            counts.append(Result.select().count())
+        # Only the changed transform and its dependants are computed again
+        assert versions[0][0] == versions[1][0] and versions[0][1] != versions[1][1]
+        assert counts == [9, 15]
+
+
+def test_pickle5_transport():
+    for batch_size in (1, 2):
+        with WorkManager(
+            ThreeNums(),
+            (PlusOne, PlusTwo),
+            {},
+            n_processes=2,
+            batch_size=batch_size,
+            transport="pickle5",
+        ) as manager:
+            assert [d["p2"] for d in manager.fast_compute()] == [2, 3, 4]
+
+
+def traced_peak(func, *args):
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_pickle5_transport_copies():
+    # What the pool does with a result: pickled by the worker, received and
+    # unpickled by the parent
+    data = {"a": np.random.rand(2 ** 20), "b": [np.ones((512, 512))]}
+    nbytes = data["a"].nbytes + data["b"][0].nbytes
+    peaks = {}
+    for name, send, receive in (
+        ("pickle", ForkingPickler.dumps, ForkingPickler.loads),
+        (
+            "pickle5",
+            lambda obj: ForkingPickler.dumps(serialization.frame(obj)),
+            lambda msg: serialization.unframe(ForkingPickler.loads(msg)),
+        ),
+    ):
+        message, sent = traced_peak(send, data)
+        message = bytes(message)
+        result, received = traced_peak(receive, message)
+        assert np.all(result["a"] == data["a"]) and np.all(result["b"][0] == 1)
+        peaks[name] = sent, received
+    # One copy into the pickle (and the stream), one out of it in the parent
+    assert peaks["pickle5"][0] < 2.2 * nbytes and peaks["pickle5"][1] < 1.2 * nbytes
+    assert all(p5 <= 1.05 * p for p5, p in zip(peaks["pickle5"], peaks["pickle"]))
+
+
+def test_shared_memory_transport(monkeypatch):
+    unraisable = []
+    monkeypatch.setattr(sys, "unraisablehook", unraisable.append)
+    transport = SharedMemoryTransport(segments=2, segment_size=2 ** 15, threshold=1024)
+    with WorkManager(
+        ThreeNums(), (Ones,), {}, n_processes=2, transport=transport
+    ) as manager:
+        for _ in range(2):
+            results = list(manager.fast_compute())
+            for num, data in enumerate(results):
+                ones, small = data["ones"][0], data["ones"][1]["small"]
+                assert ones.shape == (num + 1, 1000) and np.all(ones == 1)
+                assert np.all(small == 1)
+            # Two segments for three large arrays, at least one went through the pipe
+            segments = [np.frombuffer(seg.buf, np.uint8) for seg in transport.segments]
+            shared = [
+                any(np.shares_memory(d["ones"][0], seg) for seg in segments)
+                for d in results
+            ]
+            assert 1 <= sum(shared) <= 2
+            del segments
+            del results, data, ones, small
+
+        kept = [d["ones"][0] for d in manager.fast_compute()]
+    # Segments are closed once the arrays viewing them are collected
+    assert all(np.all(ones == 1) for ones in kept) and transport.leased
+    del kept
+    gc.collect()
+    assert not transport.leased and not unraisable